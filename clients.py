@@ -0,0 +1,53 @@
+import os
+import threading
+
+# Clients are built on first use and then kept for the lifetime of the container, instead of at import time.
+# An invocation only pays for the clients it actually uses, and importing a handler doesn't import boto3.
+region = 'us-east-1'
+
+
+class Lazy:
+    # Stands in for an object that is built by build on first attribute access. Building is locked, as the
+    # server mode and the batch helpers use clients from several threads.
+    def __init__(self, build):
+        self._build = build
+        self._value = None
+        self._lock = threading.Lock()
+
+    def get(self):
+        if self._value is None:
+            with self._lock:
+                if self._value is None:
+                    self._value = self._build()
+        return self._value
+
+    def __getattr__(self, name):
+        return getattr(self.get(), name)
+
+
+class LazyTable(Lazy):
+    # the name is known without building the table, most batch calls only need that
+    def __init__(self, name):
+        Lazy.__init__(self, lambda: dynamodb.get().Table(name))
+        self.name = name
+
+
+def build_dynamodb():
+    import boto3
+    from botocore.config import Config
+    # DYNAMODB_ENDPOINT points at a local stand-in like DynamoDB Local, the pool is sized for the number of
+    # requests the server mode handles at once
+    return boto3.resource('dynamodb', region_name=region, endpoint_url=os.environ.get('DYNAMODB_ENDPOINT'),
+                          config=Config(max_pool_connections=int(os.environ.get('DYNAMODB_POOL_SIZE', 10))))
+
+
+dynamodb = Lazy(build_dynamodb)
+tables = {}
+tables_lock = threading.Lock()
+
+
+def table(name):
+    with tables_lock:
+        if name not in tables:
+            tables[name] = LazyTable(name)
+        return tables[name]
@@ -0,0 +1,136 @@
+import time
+from random import uniform
+from concurrent.futures import ThreadPoolExecutor
+
+# dynamodb limits for a single BatchWriteItem and BatchGetItem call
+max_batch_write = 25
+max_batch_get = 100
+
+
+def backoff(attempt, base=0.05, cap=5.0):
+    # full jitter, see https://aws.amazon.com/blogs/architecture/exponential-backoff-and-jitter/
+    return uniform(0, min(cap, base * (2 ** attempt)))
+
+
+def batch_get(dynamodb, table_name, keys, max_workers=4, max_retries=10, **kwargs):
+    # Reads all keys with BatchGetItem calls of 100 which are sent in parallel. Keys that come back as
+    # unprocessed are retried with backoff. The order of the returned items is undefined.
+    client = dynamodb.meta.client
+    chunks = [keys[i:i + max_batch_get] for i in range(0, len(keys), max_batch_get)]
+
+    def read(chunk):
+        items = []
+        request_items = {table_name: dict(kwargs, Keys=chunk)}
+        attempt = 0
+        while len(request_items) > 0:
+            response = client.batch_get_item(RequestItems=request_items)
+            items.extend(response['Responses'].get(table_name, []))
+            request_items = response.get('UnprocessedKeys', {})
+            if len(request_items) > 0:
+                attempt += 1
+                if attempt > max_retries:
+                    raise RuntimeError('Giving up on %d unprocessed keys after %d retries'
+                                       % (len(request_items[table_name]['Keys']), max_retries))
+                time.sleep(backoff(attempt))
+        return items
+
+    if len(chunks) == 0:
+        return []
+    if len(chunks) == 1:
+        return read(chunks[0])
+
+    result = []
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(chunks))) as executor:
+        for items in executor.map(read, chunks):
+            result.extend(items)
+    return result
+
+
+class BatchWriter:
+    # Groups put and delete requests for any number of tables into BatchWriteItem calls of 25 and sends
+    # several of them at once. The low level client is thread safe, the resource is not, so only the client
+    # is shared with the worker threads.
+    def __init__(self, dynamodb, max_workers=4, max_retries=10):
+        self.client = dynamodb.meta.client
+        self.max_workers = max_workers
+        self.max_retries = max_retries
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.pending = []
+        self.futures = []
+        self.items = 0
+        self.retries = 0
+        self.started = time.time()
+
+    def put(self, table_name, item):
+        self._add(table_name, {'PutRequest': {'Item': item}})
+
+    def delete(self, table_name, key):
+        self._add(table_name, {'DeleteRequest': {'Key': key}})
+
+    def update(self, table_name, **kwargs):
+        # UpdateItem can't be batched, so updates are only run concurrently on the same workers
+        kwargs['TableName'] = table_name
+        self.futures.append(self.executor.submit(self._update, kwargs))
+        self._limit_in_flight()
+
+    def _update(self, kwargs):
+        try:
+            self.client.update_item(**kwargs)
+        except self.client.exceptions.ConditionalCheckFailedException:
+            # updates with a ConditionExpression that doesn't hold are skipped, not failed
+            return 0
+        return 1
+
+    def _add(self, table_name, request):
+        self.pending.append((table_name, request))
+        if len(self.pending) >= max_batch_write:
+            self._submit()
+
+    def _submit(self):
+        batch = self.pending[:max_batch_write]
+        self.pending = self.pending[max_batch_write:]
+
+        request_items = {}
+        for table_name, request in batch:
+            request_items.setdefault(table_name, []).append(request)
+        self.futures.append(self.executor.submit(self._write, request_items, len(batch)))
+        self._limit_in_flight()
+
+    def _limit_in_flight(self):
+        # keep the number of requests in flight bounded, so callers streaming items into the writer
+        # do not build up an unbounded queue in memory
+        while len(self.futures) > self.max_workers * 2:
+            self.items += self.futures.pop(0).result()
+
+    def _write(self, request_items, count):
+        attempt = 0
+        while len(request_items) > 0:
+            response = self.client.batch_write_item(RequestItems=request_items)
+            request_items = response.get('UnprocessedItems', {})
+            if len(request_items) > 0:
+                attempt += 1
+                self.retries += 1
+                if attempt > self.max_retries:
+                    raise RuntimeError('Giving up on %d unprocessed items after %d retries'
+                                       % (sum(len(r) for r in request_items.values()), self.max_retries))
+                time.sleep(backoff(attempt))
+        return count
+
+    def flush(self):
+        while len(self.pending) > 0:
+            self._submit()
+        while len(self.futures) > 0:
+            self.items += self.futures.pop(0).result()
+
+    def close(self):
+        self.flush()
+        self.executor.shutdown()
+        elapsed = max(time.time() - self.started, 0.001)
+        print('Wrote %d items in %.2fs (%.1f items/s, %d retries)'
+              % (self.items, elapsed, self.items / elapsed, self.retries))
+        return {
+            'items': self.items,
+            'seconds': elapsed,
+            'items_per_second': self.items / elapsed,
+            'retries': self.retries
+        }
@@ -0,0 +1,132 @@
+import os
+import time
+import threading
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from clients import Lazy
+
+# ESI allows 100 errors per minute window, see x-esi-error-limit-remain and x-esi-error-limit-reset.
+# Once that is used up every request fails with 420 until the window resets.
+error_limit = 100
+# below this many remaining errors no new requests are sent until the window resets
+error_limit_reserve = 10
+request_timeout = 30
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.time()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.time()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait_time = (1 - self.tokens) / self.rate
+            time.sleep(wait_time)
+
+
+class EsiClient:
+    # Shared client for ESI requests. get returns a future like FuturesSession does. Requests go through a
+    # token bucket and a concurrency limit, which shrinks as the error limit budget is used up and pauses all
+    # requests until the error window resets when the budget is nearly gone.
+    def __init__(self, max_concurrency, rate, burst=None):
+        # imported here, as only handlers that send esi requests need it
+        import requests
+        self.max_concurrency = max_concurrency
+        self.limit = max_concurrency
+        self.active = 0
+        self.paused_until = 0
+        self.condition = threading.Condition()
+        self.bucket = TokenBucket(rate, burst if burst is not None else rate)
+        self.counters = Counter()
+        self.counters_lock = threading.Lock()
+
+        self.http = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=max_concurrency)
+        self.http.mount('https://', adapter)
+        self.executor = ThreadPoolExecutor(max_workers=max_concurrency)
+
+    def get(self, url, headers=None, parse=None, **kwargs):
+        return self.executor.submit(self.request, url, headers, parse, **kwargs)
+
+    def request(self, url, headers=None, parse=None, **kwargs):
+        # parse is called with a streamed response on the worker thread, its result is stored as response.parsed
+        if parse is not None:
+            kwargs['stream'] = True
+        self.enter()
+        try:
+            self.bucket.acquire()
+            response = self.http.get(url, headers=headers, timeout=request_timeout, **kwargs)
+        finally:
+            self.leave()
+        self.observe(response)
+        if parse is not None:
+            try:
+                response.parsed = parse(response)
+            finally:
+                response.close()
+        return response
+
+    def enter(self):
+        with self.condition:
+            while True:
+                paused = self.paused_until - time.time()
+                if paused > 0:
+                    self.condition.wait(paused)
+                elif self.active >= self.limit:
+                    self.condition.wait()
+                else:
+                    break
+            self.active += 1
+
+    def leave(self):
+        with self.condition:
+            self.active -= 1
+            self.condition.notify_all()
+
+    def count(self, name):
+        with self.counters_lock:
+            self.counters[name] += 1
+
+    def observe(self, response):
+        self.count('requests')
+        if response.status_code == 304:
+            self.count('not_modified')
+        elif response.status_code >= 400:
+            self.count('errors')
+
+        headers = response.headers
+        if 'x-esi-error-limit-remain' not in headers:
+            return
+        remain = int(headers['x-esi-error-limit-remain'])
+        reset = int(headers.get('x-esi-error-limit-reset', 60))
+
+        with self.condition:
+            if response.status_code == 420 or remain <= error_limit_reserve:
+                self.count('throttled')
+                self.paused_until = max(self.paused_until, time.time() + reset + 1)
+                self.limit = 1
+                print('ESI error limit nearly reached (%d remaining), pausing for %ds' % (remain, reset))
+            else:
+                # scale the concurrency down with the share of the error budget that is left
+                self.limit = max(1, self.max_concurrency * remain // error_limit)
+            self.condition.notify_all()
+
+    def stats(self):
+        with self.counters_lock:
+            result = dict(self.counters)
+        result['concurrency_limit'] = self.limit
+        return result
+
+
+# built on first use, so handlers that import esi without using it don't start its threads and session
+client = Lazy(lambda: EsiClient(int(os.environ.get('ESI_CONCURRENCY', 24)), float(os.environ.get('ESI_RATE', 50))))
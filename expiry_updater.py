@@ -1,22 +1,33 @@
-from requests_futures.sessions import FuturesSession
-import boto3
 import time
 import math
-from boto3.dynamodb.conditions import Key
 from random import randint
-from uuid import uuid4
 from datetime import datetime
-
-session = FuturesSession()
-
-dynamodb = boto3.resource('dynamodb', region_name='us-east-1')
-structures_table = dynamodb.Table('contract-appraisal-structures')
-contracts_table = dynamodb.Table('contract-appraisal-contracts')
-scheduling_table = dynamodb.Table('contract-appraisal-scheduling')
+import esi
+from dynamo_batch import batch_get, BatchWriter
+import scheduler
+import clients
+from invocation import remaining_seconds
+from http_cache import ResponseCache
+
+dynamodb = clients.dynamodb
+structures_table = clients.table('contract-appraisal-structures')
+contracts_table = clients.table('contract-appraisal-contracts')
+recheck_table = clients.table('contract-appraisal-recheck-schedule')
+
+# seconds kept free at the end of a run for the remaining writes
+time_reserve = 10
+# small enough waves to adapt the size of the next one to the observed throughput
+max_wave_size = 200
+smoothing = 0.3
+# smoothed across warm invocations, starts with a conservative guess
+seconds_per_contract = 0.2
 
 
 def handle(event, context):
-    contracts = []
+    # Rechecks used to be scheduled with ttl rows in contract-appraisal-scheduling. They are scheduled in time
+    # buckets by now (see handle_due), this only works off the rows which are still around from before.
+    contracts = {}
+    lookups = []
     for record in event['Records']:
 
         # as we're using ttl to schedule executions, we do not care about inserts or updates,
@@ -30,41 +41,110 @@ def handle(event, context):
         old_image = item['OldImage']
         contract_id = int(old_image['contract_id']['N'])
 
-        contract = get_contract(contract_id)
-        if contract is None:
-            # if we can't find the contract then we have to ignore it
-            # i don't know how this could happen, but i don't want the script to fail
-            continue
-        contracts.append(contract)
+        # scheduling rows carry the few fields needed here, only rows written before that need a lookup
+        if 'date_issued' in old_image:
+            contract = {
+                'contract_id': contract_id,
+                'date_issued': old_image['date_issued']['S']
+            }
+            if 'ETag' in old_image:
+                contract['ETag'] = old_image['ETag']['S']
+            contracts[contract_id] = contract
+        else:
+            lookups.append(contract_id)
+
+    if len(lookups) > 0:
+        # contracts we can't find are ignored, i don't know how this could happen, but i don't want the script to fail
+        for contract in get_contracts(lookups):
+            contracts[contract['contract_id']] = contract
+    # keyed by id before, as a contract may have been scheduled twice and would then be rescheduled twice
+    contracts = list(contracts.values())
+
+    writer = BatchWriter(dynamodb)
 
     # if we are running into downtime, then reschedule the contracts
     now = datetime.now()
     if now.hour == 11 and now.minute < 10:
         for c in contracts:
-            reschedule(c, within_hour=True)
+            reschedule(c, within_hour=True, writer=writer)
+        writer.close()
         return
 
-    if len(contracts) > 100:
-        print('rescheduling %d contracts' % (len(contracts) - 100))
-        reschedule_contracts = contracts[100:]
-        for r in reschedule_contracts:
-            reschedule(r, within_hour=True)
-        contracts = contracts[:100]
-
     if len(contracts) > 0:
         print('processing %d contracts' % len(contracts))
-        process_contracts(contracts)
-
+        cache = ResponseCache(dynamodb)
+        deferred = process_within_budget(contracts, context, writer, cache)
+        if len(deferred) > 0:
+            print('rescheduling %d contracts' % len(deferred))
+            for r in deferred:
+                reschedule(r, within_hour=True, writer=writer)
+        cache.flush(writer)
+        print('ESI stats: %s' % esi.client.stats())
+    writer.close()
+
+
+def handle_due(event, context):
+    # runs periodically and rechecks the contracts of every bucket that is due
+    now = datetime.now()
+    if now.hour == 11 and now.minute < 10:
+        # the cursor stays where it is, so the buckets are picked up after downtime
+        return
 
-def process_contracts(contracts):
+    buckets = scheduler.due_buckets(recheck_table, time.time())
+    print('%d buckets are due' % len(buckets))
+
+    writer = BatchWriter(dynamodb)
+    cache = ResponseCache(dynamodb)
+    for bucket in buckets:
+        if remaining_seconds(context) < time_reserve * 2:
+            break
+        contracts = [scheduler.to_contract(i) for i in scheduler.read_bucket(recheck_table, bucket)]
+        print('processing %d contracts of bucket %d' % (len(contracts), bucket))
+        deferred = process_within_budget(contracts, context, writer, cache)
+        if len(deferred) > 0:
+            print('rescheduling %d contracts' % len(deferred))
+            for r in deferred:
+                reschedule(r, within_hour=True, writer=writer)
+        # everything of the bucket is written before the cursor moves past it
+        cache.flush(writer)
+        writer.flush()
+        scheduler.set_cursor(recheck_table, bucket + scheduler.bucket_size)
+    writer.close()
+    print('ESI stats: %s' % esi.client.stats())
+
+
+def process_within_budget(contracts, context, writer, cache):
+    # Processes contracts in waves, each sized by how many contracts fit into the remaining time at the throughput
+    # observed so far. The throughput already reflects esi latency and the concurrency the esi client allows for
+    # the remaining error budget. Returns the contracts that didn't fit.
+    global seconds_per_contract
+    deadline = time.time() + remaining_seconds(context) - time_reserve
+    while len(contracts) > 0:
+        available = deadline - time.time()
+        # while the error limit is exhausted, no request would go out anyway
+        available -= max(0, esi.client.paused_until - time.time())
+        wave_size = min(max_wave_size, len(contracts), int(available / seconds_per_contract))
+        if wave_size <= 0:
+            break
+
+        wave = contracts[:wave_size]
+        contracts = contracts[wave_size:]
+        started = time.time()
+        process_contracts(wave, writer, cache)
+        observed = (time.time() - started) / len(wave)
+        seconds_per_contract = (1 - smoothing) * seconds_per_contract + smoothing * observed
+        print('processed %d contracts at %.3fs per contract' % (len(wave), observed))
+    return contracts
+
+
+def process_contracts(contracts, writer, cache):
+    # the first items page tells whether the contract is still up, its body is not needed here
+    urls = ['https://esi.evetech.net/v1/contracts/public/items/%d/' % c['contract_id'] for c in contracts]
+    cache.prefetch(urls)
     futures = []
-    for contract in contracts:
-        headers = {}
-        if 'ETag' in contract:
-            headers['If-None-Match'] = contract['ETag']
+    for contract, url in zip(contracts, urls):
         futures.append({
-            'future': session.get(url='https://esi.evetech.net/v1/contracts/public/items/%d' % contract['contract_id'],
-                                  headers=headers),
+            'future': cache.get(esi.client, url, need_body=False, etag=contract.get('ETag')),
             'contract': contract
         })
 
@@ -74,26 +154,13 @@ def process_contracts(contracts):
 
         score = 0
         print('received status code %d for contract %d' % (response.status_code, contract['contract_id']))
-        if 'x-esi-error-limit-remain' in response.headers and response.status_code < 400:
-            lowest_remain = int(response.headers['x-esi-error-limit-remain'])
-            if lowest_remain < 100:
-                print('remaining tries before error limiting: %d' % lowest_remain)
         if response.status_code == 200:
-            etag = response.headers['ETag']
-            contracts_table.update_item(
-                Key={
-                    'contract_id': contract['contract_id']
-                },
-                UpdateExpression="SET ETag = :s",
-                ExpressionAttributeValues={
-                    ':s': etag,
-                },
-                ReturnValues="NONE"
-            )
-            reschedule(contract)
+            # the page itself is kept in the response cache, the ETag also goes into the recheck row
+            contract['ETag'] = response.headers['ETag']
+            reschedule(contract, writer=writer)
             continue
         elif response.status_code == 304 or response.status_code == 204:
-            reschedule(contract)
+            reschedule(contract, writer=writer)
             continue
         elif response.status_code == 403:
             error = response.json()
@@ -110,7 +177,7 @@ def process_contracts(contracts):
             pass
         else:
             if response.status_code >= 420:
-                reschedule(contract)
+                reschedule(contract, writer=writer)
                 continue
             else:
                 print('unknown error code %d, %s' % (response.status_code, response.content))
@@ -118,7 +185,8 @@ def process_contracts(contracts):
         score = round(score * 100)
 
         date_scored = datetime.strftime(datetime.now(), '%Y-%m-%dT%H:%M:%SZ')
-        contracts_table.update_item(
+        writer.update(
+            contracts_table.name,
             Key={
                 'contract_id': contract['contract_id']
             },
@@ -132,7 +200,7 @@ def process_contracts(contracts):
         print('scored %d with %d' % (contract['contract_id'], score))
 
 
-def reschedule(contract, within_hour=False):
+def reschedule(contract, within_hour=False, writer=None):
     contract_age = get_age(contract['date_issued'])
     if not within_hour and 'date_issued' in contract and contract_age.days >= 1:
 
@@ -155,22 +223,20 @@ def reschedule(contract, within_hour=False):
 
     print('rescheduling %d with a delay of %d seconds' % (contract['contract_id'], delay))
 
-    scheduling_table.put_item(
-        Item={
-            'id': str(uuid4()),
-            'contract_id': contract['contract_id'],
-            'ttl': int(time.time()) + delay
-        }
-    )
-
-
-def get_contract(contract_id):
-    response = contracts_table.query(
-        KeyConditionExpression=Key('contract_id').eq(contract_id)
-    )
-    if response['Count'] == 0:
-        return None
-    return response['Items'][0]
+    item = scheduler.schedule_item(contract, int(time.time()) + delay)
+    if writer is None:
+        recheck_table.put_item(Item=item)
+    else:
+        writer.put(recheck_table.name, item)
+
+
+def get_contracts(contract_ids):
+    keys = [{'contract_id': contract_id} for contract_id in set(contract_ids)]
+    contracts = batch_get(dynamodb, contracts_table.name, keys,
+                          ProjectionExpression='contract_id, date_issued, ETag')
+    for contract in contracts:
+        contract['contract_id'] = int(contract['contract_id'])
+    return contracts
 
 
 def get_age(date_string):
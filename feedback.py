@@ -1,14 +1,10 @@
 import json
-from requests_futures.sessions import FuturesSession
-import boto3
 import os
 from decimal import Decimal
 from uuid import uuid4
+import clients
 
-session = FuturesSession()
-
-dynamodb = boto3.resource('dynamodb', region_name='us-east-1')
-feedback_table = dynamodb.Table('contract-appraisal-feedback')
+feedback_table = clients.table('contract-appraisal-feedback')
 
 
 def handle(event, context):
@@ -0,0 +1,80 @@
+import time
+import threading
+from collections import Counter
+
+# counts are collected per container and only written every so often, so requests don't pay for a write each
+flush_interval = 60
+# rows of filter combinations that weren't requested for this long are removed by TTL
+row_retention = 30 * 24 * 60 * 60
+# Requests are also counted per day, in attributes named day<days since the epoch>, so combinations are ranked
+# by how often they were requested within the last recent_days days. Older day counts are removed on update.
+day_seconds = 24 * 60 * 60
+recent_days = 7
+# hot_filter_keys scans the table, its result is kept for this long by every container
+hot_cache_time = 5 * 60
+hot_cache = {}
+
+counts = Counter()
+last_flush = time.time()
+# the server mode records from several threads, only one of them writes the collected counts
+lock = threading.Lock()
+
+
+def record(key, amount=1):
+    with lock:
+        counts[key] += amount
+
+
+def flush(table, force=False):
+    global counts, last_flush
+    with lock:
+        if len(counts) == 0 or (not force and time.time() - last_flush < flush_interval):
+            return
+        pending = counts
+        counts = Counter()
+        last_flush = time.time()
+    now = int(time.time())
+    today = now // day_seconds
+    names = {'#count': 'count', '#ttl': 'ttl', '#today': day_attribute(today)}
+    # the day counts that dropped out of the counted days, so rows don't collect one attribute per day
+    for i in range(recent_days):
+        names['#old%d' % i] = day_attribute(today - recent_days - i)
+    expression = "ADD #count :c, #today :c SET last_seen = :now, #ttl = :ttl REMOVE %s" \
+                 % ', '.join('#old%d' % i for i in range(recent_days))
+    for key, count in pending.items():
+        table.update_item(
+            Key={'filter_key': key},
+            UpdateExpression=expression,
+            ExpressionAttributeNames=names,
+            ExpressionAttributeValues={':c': count, ':now': now, ':ttl': now + row_retention},
+            ReturnValues="NONE"
+        )
+
+
+def day_attribute(day):
+    return 'day%d' % day
+
+
+def hot_filter_keys(table, limit):
+    # the filter combinations that were requested most often within the last recent_days days, most requested first
+    key = (table.name, limit)
+    cached = hot_cache.get(key)
+    if cached is not None and cached[0] > time.time():
+        return cached[1]
+
+    items = []
+    kwargs = {}
+    while True:
+        response = table.scan(**kwargs)
+        items.extend(response['Items'])
+        if 'LastEvaluatedKey' not in response:
+            break
+        kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+    today = int(time.time()) // day_seconds
+    days = [day_attribute(today - i) for i in range(recent_days)]
+    recent = [(sum(int(i.get(d, 0)) for d in days), i['filter_key']) for i in items]
+    recent.sort(key=lambda r: (-r[0], r[1]))
+    result = [filter_key for count, filter_key in recent[:limit] if count > 0]
+    hot_cache[key] = (time.time() + hot_cache_time, result)
+    return result
@@ -1,93 +1,277 @@
 import json
-from requests_futures.sessions import FuturesSession
-import boto3
-from statistics import median
+import hashlib
 from decimal import Decimal
 import time
 from wsgiref.handlers import format_date_time
 import os
+import re
 import urllib.parse
-
-session = FuturesSession()
-
-dynamodb = boto3.resource('dynamodb', region_name='us-east-1')
-price_cache_table = dynamodb.Table('contract-appraisal-price-cache')
-prices_v2 = dynamodb.Table('contract-appraisal-prices-v2')
-refined_table = dynamodb.Table('contract-appraisal-refined')
+from price_cache import PriceCache, TypeDataCache
+from dynamo_batch import batch_get, BatchWriter
+from price_data import map_price_data_from_dynamo
+import quantiles
+import price_encoding
+import leases
+import filter_stats
+import clients
+from price_filters import default_filters, security_mask, security_names, all_securities, filter_key, get_cache_id, \
+    parse_since, window_start
+
+dynamodb = clients.dynamodb
+price_cache_table = clients.table('contract-appraisal-price-cache')
+prices_v2 = clients.table('contract-appraisal-prices-v2')
+refined_table = clients.table('contract-appraisal-refined')
+refined_chunks_table = clients.table('contract-appraisal-refined-chunks')
+leases_table = clients.table('contract-appraisal-leases')
+filter_stats_table = clients.table('contract-appraisal-filter-stats')
 
 cache_time = (10 * 24 * 60 * 60)  # first number is days
-
-
-def average(lst):
-    if len(lst) == 0:
-        return 0
-    return sum(lst) / len(lst)
+# v2 entries are refreshed in place, so they are only kept in memory for a while, but served with their real expiry
+memory_cache_time = 60 * 60
+empty_cache_time = 60 * 60
+# results for the last max_age days change as the window moves on, even without new contracts, so they are kept
+# for a tenth of the window, but never longer than window_cache_time
+window_cache_time = 24 * 60 * 60
+window_cache_fraction = 10
+# a miss is recomputed by one invocation only, the others serve the stale result or wait for the new one
+lease_time = 30
+lease_wait_time = 3
+stale_response_time = 60
+
+max_bulk_type_ids = 500
+# the highest research levels a blueprint can have
+max_material_efficiency = 10
+max_time_efficiency = 20
+# additional percentiles returned as p10, p25 and p75, they come for free with the sort done for the median
+percentiles = (10, 25, 75)
+
+# refined price data kept in memory, only the long running server mode has room for it by default
+refined_cache_time = 5 * 60
+# path of the price route behind a load balancer, which passes the whole path instead of path parameters
+price_path = re.compile(r'^/prices/(\d+)/?$')
+
+# lives across warm invocations, sized to leave most of the 128 MB for loading refined price data
+price_cache = PriceCache(int(os.environ.get('PRICE_CACHE_BYTES', 16 * 1024 * 1024)))
+refined_cache = TypeDataCache(int(os.environ.get('REFINED_CACHE_BYTES', 0)))
 
 
 def handle(event, context):
     if os.environ.get('DEBUG') == 'true':
         print(event)
 
-    is_aws_load_balancer = False
+    is_aws_load_balancer = is_load_balancer_event(event)
+    if_none_match = get_header(event, 'If-None-Match')
 
     if is_aws_load_balancer:
-        # event['path'] # todo: extract type_id from alb path
-        type_id = 1
+        match = price_path.match(event['path'])
+        if match is None:
+            return bad_request("Expected a path like /prices/<type_id>.", is_aws_load_balancer)
+        type_id = int(match.group(1))
     else:
         type_id = int(event['pathParameters']['type_id'])
 
     print("type_id: %d" % type_id)
 
-    material_efficiency = None
-    time_efficiency = None
-    include_private = False
-    security = "highsec,lowsec,nullsec,wormhole"
-    bpc = False
-    if 'queryStringParameters' in event and event['queryStringParameters'] is not None:
-        print(event['queryStringParameters'])
-        query_parameters = event['queryStringParameters']
+    try:
+        filters = parse_filters(event.get('queryStringParameters'))
+    except ValueError as e:
+        return bad_request(str(e), is_aws_load_balancer)
+
+    record_filters(filters)
+
+    cache_id = get_cache_id(type_id, filters)
+    print("cache_id:%s" % cache_id)
+    cached, stale, refresh_v2 = get_cached_price(cache_id)
+    print("Memory cache stats: %s" % price_cache.stats())
+    if cached is not None:
+        return respond(cached, is_aws_load_balancer, if_none_match)
+    print("Cache miss for %s" % cache_id)
+
+    lease_id = 'price-%s' % cache_id
+    owner = leases.acquire(leases_table, lease_id, lease_time)
+    if owner is None:
+        # another invocation is already recomputing this cache_id, so don't load the refined item a second time
+        if stale is not None:
+            print("Serving stale result for %s" % cache_id)
+            return respond((stale[0], time.time() + stale_response_time), is_aws_load_balancer, if_none_match)
+        cached = wait_for_price(cache_id)
+        if cached is not None:
+            return respond(cached, is_aws_load_balancer, if_none_match)
+        print("Gave up waiting for %s, computing it here" % cache_id)
+
+    try:
+        print('Loading Price Data ...')
+        # taken before the refined data is read, so a change after that still marks a rewritten v2 row stale
+        updated = int(time.time())
+        price_data = get_price_data(type_id, filters['bpc'])
+
+        result = None
+        if price_data is None:
+            print('Found no price data')
+        else:
+            result = calculate_price(price_data, filters)
+
+        expires = store_price(cache_id, result, lifetime=cache_lifetime(filters))
+        if refresh_v2:
+            store_v2_price(cache_id, result, updated)
+    finally:
+        if owner is not None:
+            leases.release(leases_table, lease_id, owner)
+
+    return respond((result, expires), is_aws_load_balancer, if_none_match)
+
+
+def handle_bulk(event, context):
+    if os.environ.get('DEBUG') == 'true':
+        print(event)
+
+    is_aws_load_balancer = is_load_balancer_event(event)
+    query_parameters = event.get('queryStringParameters') or {}
+    try:
+        type_ids = sorted(set(int(t) for t in urllib.parse.unquote(query_parameters.get('type_ids', '')).split(',')
+                              if t.strip() != ''))
+    except ValueError:
+        return bad_request("The parameter type_ids must be a comma separated list of type ids.", is_aws_load_balancer)
+    if len(type_ids) == 0 or len(type_ids) > max_bulk_type_ids:
+        return bad_request("The parameter type_ids must contain between 1 and %d type ids." % max_bulk_type_ids,
+                           is_aws_load_balancer)
+
+    try:
+        filters = parse_filters(query_parameters)
+    except ValueError as e:
+        return bad_request(str(e), is_aws_load_balancer)
+
+    record_filters(filters, len(type_ids))
+
+    print("Resolving prices for %d type ids" % len(type_ids))
+
+    cache_ids = {}
+    for type_id in type_ids:
+        cache_ids[get_cache_id(type_id, filters)] = type_id
+
+    found, refresh_v2 = get_cached_prices(list(cache_ids.keys()))
+    print("Memory cache stats: %s" % price_cache.stats())
+
+    results = {}
+    expires = int(time.time()) + cache_time
+    for cache_id, (item, item_expires) in found.items():
+        results[cache_ids[cache_id]] = item
+        expires = min(expires, int(item_expires))
+
+    misses = [type_id for cache_id, type_id in cache_ids.items() if cache_id not in found]
+    print("Cache misses for %d of %d type ids" % (len(misses), len(type_ids)))
+
+    if len(misses) > 0:
+        writer = BatchWriter(dynamodb)
+        updated = int(time.time())
+        for price_data in get_price_data_bulk(misses, filters['bpc']):
+            results[price_data.type_id] = calculate_price(price_data, filters)
+        for type_id in misses:
+            cache_id = get_cache_id(type_id, filters)
+            # types without any refined data are cached as empty as well
+            expires = min(expires, store_price(cache_id, results.get(type_id), writer, cache_lifetime(filters)))
+            if cache_id in refresh_v2:
+                store_v2_price(cache_id, results.get(type_id), updated, writer)
+        writer.close()
+
+    body = {}
+    for type_id in type_ids:
+        body[str(type_id)] = results.get(type_id)
+
+    return build_response(body, expires, is_aws_load_balancer, get_header(event, 'If-None-Match'))
+
+
+def record_filters(filters, amount=1):
+    # time windows are never precomputed, and every distinct since would become a stats row of its own
+    if filters['max_age'] is None and filters['since'] is None:
+        filter_stats.record(filter_key(filters), amount)
+    filter_stats.flush(filter_stats_table)
+
+
+def is_load_balancer_event(event):
+    return 'elb' in (event.get('requestContext') or {})
+
+
+def get_header(event, name):
+    # api gateway passes headers as sent, the load balancer in lower case
+    name = name.lower()
+    for key, value in (event.get('headers') or {}).items():
+        if key.lower() == name:
+            return value
+    return None
+
+
+def parse_filters(query_parameters):
+    # raises a ValueError with a message for the client for invalid parameters
+    filters = default_filters()
+    if query_parameters is not None:
+        print(query_parameters)
         if 'security' in query_parameters:
             # decoding is required as ALB does not decode url parameters
-            security = urllib.parse.unquote(query_parameters['security'])
+            filters['securities'] = security_mask(urllib.parse.unquote(query_parameters['security']))
         if 'material_efficiency' in query_parameters:
-            material_efficiency = int(query_parameters['material_efficiency'])
+            filters['material_efficiency'] = parse_efficiency(query_parameters['material_efficiency'],
+                                                             max_material_efficiency)
         if 'time_efficiency' in query_parameters:
-            time_efficiency = int(query_parameters['time_efficiency'])
+            filters['time_efficiency'] = parse_efficiency(query_parameters['time_efficiency'], max_time_efficiency)
         if 'include_private' in query_parameters:
-            include_private = query_parameters['include_private'].lower() == "true"
-            if include_private and security != "highsec,lowsec,nullsec,wormhole":
-                return {
-                    "statusCode": 400,
-                    "body": json.dumps({ "error": "Combining the parameter include_private=true with non-default "
-                                                  "securities does not return any data and is therefore prevented." }),
-                    "headers": {
-                        "Access-Control-Allow-Origin": "*",
-                        "Access-Control-Allow-Credentials": "true"
-                    }
-                }
+            filters['include_private'] = query_parameters['include_private'].lower() == "true"
+            if filters['include_private'] and filters['securities'] != all_securities:
+                raise ValueError("Combining the parameter include_private=true with non-default "
+                                 "securities does not return any data and is therefore prevented.")
         if 'bpc' in query_parameters:
-            bpc = query_parameters['bpc'].lower() == "true"
+            filters['bpc'] = query_parameters['bpc'].lower() == "true"
+        if 'weighted' in query_parameters:
+            filters['weighted'] = query_parameters['weighted'].lower() == "true"
+        if 'max_age' in query_parameters:
+            filters['max_age'] = parse_integer(query_parameters['max_age'],
+                                               "The parameter max_age must be a positive number of days.")
+            if filters['max_age'] <= 0:
+                raise ValueError("The parameter max_age must be a positive number of days.")
+        if 'since' in query_parameters:
+            filters['since'] = parse_since(urllib.parse.unquote(query_parameters['since']))
+        if filters['max_age'] is not None and filters['since'] is not None:
+            raise ValueError("The parameters max_age and since can't be combined.")
+    return filters
+
+
+def parse_efficiency(value, maximum):
+    message = "Efficiencies must be between 0 and %d." % maximum
+    efficiency = parse_integer(value, message)
+    if efficiency < 0 or efficiency > maximum:
+        raise ValueError(message)
+    return efficiency
+
+
+def parse_integer(value, message):
+    # the message of int() is not meant for clients
+    try:
+        return int(value)
+    except ValueError:
+        raise ValueError(message)
+
+
+def get_cached_price(cache_id):
+    # Returns the cached (result, expires) if there is a fresh one, an expired (result, expires) if there is one,
+    # and whether the prices_v2 row has to be replaced by the recomputed result.
+    cached = price_cache.get(cache_id)
+    if cached is not None:
+        print("Memory cache hit for %s" % cache_id)
+        return cached, None, False
 
-    cache_id = "%d-%s-%s-%s-%s-%s" % (type_id, material_efficiency, time_efficiency, include_private, security, bpc)
-    print("cache_id:%s" % cache_id)
     if os.environ.get('PRICES_V2') == 'true':
         response = prices_v2.query(
             KeyConditionExpression="price_key = :cache_id",
             ExpressionAttributeValues={":cache_id": cache_id}
         )
         if response['Count'] > 0:
-            print("Cache V2 hit for %s" % cache_id)
-            item = response['Items'][0]
-            item['average'] = float(item['average'])
-            item['five_percent'] = float(item['five_percent'])
-            item['maximum'] = float(item['maximum'])
-            item['median'] = float(item['median'])
-            item['minimum'] = float(item['minimum'])
-            item['type_id'] = int(item['type_id'])
-            if 'contracts' in item:
-                item['contracts'] = int(item['contracts'])
-            del item['price_key']
-            return build_response(item, time.time() + cache_time, is_aws_load_balancer)
+            cached = map_v2_cache_item(response['Items'][0])
+            if cached[1] > time.time():
+                print("Cache V2 hit for %s" % cache_id)
+                return cached, None, False
+            # Stale or expired. Precompute only rewrites a row when the refined data of its type changes, so the
+            # recomputed result replaces it, otherwise it would be recomputed on every request from now on.
+            return None, cached, True
 
     #  THE FOLLOWING CODE IS DEPRECATED AND WILL BE FADED OUT
     response = price_cache_table.query(
@@ -95,108 +279,264 @@ def handle(event, context):
         ExpressionAttributeValues={":cache_id": cache_id}
     )
     if response['Count'] > 0:
-        print("Cache V1 hit for %s" % cache_id)
-        item = response['Items'][0]
-        item['average'] = float(item['average'])
+        cached = map_v1_cache_item(response['Items'][0])
+        if cached[1] > time.time():
+            print("Cache V1 hit for %s" % cache_id)
+            return cached, None, False
+        return None, cached, False
+    return None, None, False
+
+
+def wait_for_price(cache_id):
+    deadline = time.time() + lease_wait_time
+    while time.time() < deadline:
+        time.sleep(0.25)
+        response = price_cache_table.get_item(Key={'cache_id': cache_id}, ConsistentRead=True)
+        if 'Item' in response:
+            cached = map_v1_cache_item(response['Item'])
+            if cached[1] > time.time():
+                print("Received result for %s from another invocation" % cache_id)
+                return cached
+    return None
+
+
+def get_cached_prices(cache_ids):
+    # Same lookup order as get_cached_price, but every level is read with batched requests. Returns the fresh
+    # (result, expires) by cache id, and the cache ids of the prices_v2 rows that have to be replaced.
+    found = {}
+    stale = set()
+    for cache_id in cache_ids:
+        cached = price_cache.get(cache_id)
+        if cached is not None:
+            found[cache_id] = cached
+
+    remaining = [c for c in cache_ids if c not in found]
+    if os.environ.get('PRICES_V2') == 'true' and len(remaining) > 0:
+        for item in batch_get(dynamodb, prices_v2.name, [{'price_key': c} for c in remaining]):
+            cache_id = item['price_key']
+            cached = map_v2_cache_item(item)
+            if cached[1] > time.time():
+                found[cache_id] = cached
+            else:
+                stale.add(cache_id)
+        remaining = [c for c in remaining if c not in found and c not in stale]
+
+    if len(remaining) > 0:
+        for item in batch_get(dynamodb, price_cache_table.name, [{'cache_id': c} for c in remaining]):
+            cache_id = item['cache_id']
+            cached = map_v1_cache_item(item)
+            if cached[1] > time.time():
+                found[cache_id] = cached
+
+    print("Cache hits for %d of %d cache ids" % (len(found), len(cache_ids)))
+    return found, stale
+
+
+def map_v2_cache_item(item):
+    cache_id = item['price_key']
+    map_price_fields(item)
+    item['type_id'] = int(item['type_id'])
+    if 'contracts' in item:
+        item['contracts'] = int(item['contracts'])
+    del item['price_key']
+    if 'stale' in item:
+        # marked by the refiner when the refined data changed, until precompute replaces the entry
+        expires = int(item.pop('stale'))
+        return item, expires
+    # rows that precompute doesn't rewrite anymore expire like any other cached result
+    expires = int(item['updated']) + cache_time
+    if expires <= time.time():
+        return item, expires
+    price_cache.put(cache_id, item, expires, keep_until=time.time() + memory_cache_time)
+    return item, expires
+
+
+def map_v1_cache_item(item):
+    cache_id = item['cache_id']
+    expires = int(item['ttl_date'])
+    if item.get('empty', False):
+        item = None
+    else:
         item['contracts'] = int(item['contracts'])
-        item['five_percent'] = float(item['five_percent'])
-        item['maximum'] = float(item['maximum'])
-        item['median'] = float(item['median'])
-        item['minimum'] = float(item['minimum'])
+        map_price_fields(item)
         item['type_id'] = int(item['type_id'])
-        expires = item['ttl_date']
         del item['cache_id']
         del item['ttl_date']
-        return build_response(item, expires, is_aws_load_balancer)
-    print("Cache miss for %s" % cache_id)
+    # dynamodb ttl deletion can lag behind by hours, expired entries are only used as stale results
+    if expires > time.time():
+        price_cache.put(cache_id, item, expires)
+    return item, expires
+
+
+def map_price_fields(item):
+    for key in ['median', 'average', 'minimum', 'maximum', 'five_percent'] + \
+            [quantiles.percentile_key(p) for p in percentiles]:
+        if key in item:
+            item[key] = float(item[key])
+
+
+def cache_lifetime(filters):
+    if filters['max_age'] is not None:
+        return min(window_cache_time, filters['max_age'] * 24 * 60 * 60 // window_cache_fraction)
+    return cache_time
+
+
+def store_price(cache_id, result, writer=None, lifetime=cache_time):
+    # results without any prices are cached too, but for a shorter time, as listing a single contract changes them
+    if result is None:
+        expires = int(time.time()) + min(lifetime, empty_cache_time)
+        item = {'cache_id': cache_id, 'ttl_date': expires, 'empty': True}
+    else:
+        expires = int(time.time()) + lifetime
+        item = to_cache_item(cache_id, result, expires)
+    if writer is None:
+        price_cache_table.put_item(Item=item)
+    else:
+        writer.put(price_cache_table.name, item)
+    price_cache.put(cache_id, result, expires)
+    return expires
+
+
+def store_v2_price(cache_id, result, updated, writer=None):
+    # replacing a prices_v2 row also drops its stale mark, results without any prices are only cached in v1
+    if result is None:
+        if writer is None:
+            prices_v2.delete_item(Key={'price_key': cache_id})
+        else:
+            writer.delete(prices_v2.name, {'price_key': cache_id})
+        return
+    item = dict(result)
+    item['price_key'] = cache_id
+    item['updated'] = updated
+    item = json.loads(json.dumps(item), parse_float=Decimal)
+    if writer is None:
+        prices_v2.put_item(Item=item)
+    else:
+        writer.put(prices_v2.name, item)
 
-    securities = security.split(",")
 
-    print('Loading Price Data ...')
-    price_data = get_price_data(type_id, bpc)
+def to_cache_item(cache_id, result, expires):
+    item = dict(result)
+    item['ttl_date'] = expires
+    item['cache_id'] = cache_id
+    return json.loads(json.dumps(item), parse_float=Decimal)
 
-    if price_data is None:
-        print('Found no price data')
-        return empty_response(is_aws_load_balancer)
 
-    unit_prices = []
-    contract_count = 0
-    for p in price_data.prices:
-        # include_private must not be used with non-default securities (which are highsec,lowsec,nullsec,wormhole)
-        if (include_private or p.security in securities) \
-                and (material_efficiency is None or p.material_efficiency == material_efficiency) \
-                and (time_efficiency is None or p.time_efficiency == time_efficiency):
-            # todo: consider the amount of items, don't do that by putting the price into they array times the amount as that will cause memory issues
-            unit_prices.append(p.price_per_unit)
-            if p.contract_id != 1:
-                contract_count += 1
+def calculate_price(price_data, filters):
+    # include_private must not be used with non-default securities (which are highsec,lowsec,nullsec,wormhole)
+    securities = None
+    if not filters['include_private']:
+        securities = security_names(filters['securities'])
+    start = window_start(filters, time.time())
+    if start is not None:
+        price_data = price_data.since(start)
+    mask = price_data.mask(securities, filters['material_efficiency'], filters['time_efficiency'])
 
-    print('Found %d unit prices' % len(unit_prices))
+    unit_prices = price_data.select('price_per_unit', mask)
+    contract_ids = price_data.select('contract_id', mask)
+    contract_count = len(contract_ids) - contract_ids.count(1)
+
+    print('Found %d unit prices for %d' % (len(unit_prices), price_data.type_id))
 
     if len(unit_prices) == 0:
-        return empty_response()
+        return None
 
-    five = min(unit_prices)
-    if (len(unit_prices)) >= 20:
-        five = average(unit_prices[0:int(len(unit_prices)*0.05)])
+    if filters['weighted']:
+        # every price counts once per unit, without repeating it amount times
+        statistics = quantiles.weighted_summarize(unit_prices, price_data.select('amount', mask), percentiles)
+    else:
+        statistics = quantiles.summarize(unit_prices, percentiles)
+    if statistics is None:
+        return None
 
     result = {
         'type_id': price_data.type_id,
         'type_name': price_data.type_name,
-        'median': float(median(unit_prices)),
-        'average': float(average(unit_prices)),
-        'minimum': float(min(unit_prices)),
-        'maximum': float(max(unit_prices)),
-        'five_percent': float(five),
         'contracts': contract_count
     }
+    result.update(statistics)
+    return result
+
+
+def respond(cached, is_aws_load_balancer=False, if_none_match=None):
+    # a client that already has the current result gets a 304, before any price data is loaded
+    result, expires = cached
+    if result is None:
+        return empty_response(is_aws_load_balancer, expires)
+    return build_response(result, expires, is_aws_load_balancer, if_none_match)
+
+
+def get_etag(body):
+    # derived from the result itself, so every container and cache level hands out the same tag for it
+    return '"%s"' % hashlib.sha1(body.encode('utf-8')).hexdigest()[:20]
 
-    result['ttl_date'] = int(time.time()) + cache_time # now + 5 days
-    result['cache_id'] = cache_id
-    price_cache_table.put_item(
-        Item=json.loads(json.dumps(result), parse_float=Decimal)
-    )
-    expires = result['ttl_date']
-    del result['ttl_date']
-    del result['cache_id']
 
-    return build_response(result, expires, is_aws_load_balancer)
+def etag_matches(if_none_match, etag):
+    if if_none_match is None:
+        return False
+    tags = [t.strip() for t in if_none_match.split(',')]
+    # weak comparison, as recommended for If-None-Match
+    return '*' in tags or etag in [t[2:] if t.startswith('W/') else t for t in tags]
 
 
-def empty_response(is_aws_load_balancer=False):
+def cache_headers(expires):
+    # max-age follows the remaining lifetime of the cached result, so browsers and CDNs stop asking until then
+    return {
+        "Expires": format_date_time(expires),
+        "Cache-Control": "public, max-age=%d" % max(0, int(expires - time.time())),
+        "Access-Control-Allow-Origin": "*",
+        "Access-Control-Allow-Credentials": "true"
+    }
+
+
+def bad_request(message, is_aws_load_balancer=False):
     response = {
-        "statusCode": 204,
+        "statusCode": 400,
+        "body": json.dumps({ "error": message }),
         "headers": {
-            "Expires": format_date_time(time.time() + cache_time),  # now + 5 days
             "Access-Control-Allow-Origin": "*",
             "Access-Control-Allow-Credentials": "true"
         }
     }
     if is_aws_load_balancer:
-        response['statusDescription'] = '204 No Content'
+        response['statusDescription'] = '400 Bad Request'
         response['isBase64Encoded'] = False
     return response
 
 
-def map_price_data_from_dynamo(entry):
-    prices = []
-    for i in entry['prices']:
-        prices.append(PriceElement(float(i['price_per_unit']), int(i['amount']), int(i['timestamp']),
-                                   i['security'], i['public_structure'], int(i['contract_id']),
-                                   int(i['time_efficiency']), int(i['material_efficiency'])))
-    result = TypeData(int(entry['type_id']), entry['type_name'], prices, entry['is_bpc'])
-    return result
+def empty_response(is_aws_load_balancer=False, expires=None):
+    if expires is None:
+        expires = time.time() + empty_cache_time
+    response = {
+        "statusCode": 204,
+        "headers": cache_headers(expires)
+    }
+    if is_aws_load_balancer:
+        response['statusDescription'] = '204 No Content'
+        response['isBase64Encoded'] = False
+    return response
+
 
+def build_response(result, expires, is_aws_load_balancer=False, if_none_match=None):
+    # keys are sorted, so the same result always has the same body and etag
+    body = json.dumps(result, sort_keys=True)
+    etag = get_etag(body)
+    headers = cache_headers(expires)
+    headers["ETag"] = etag
+    if etag_matches(if_none_match, etag):
+        response = {
+            "statusCode": 304,
+            "headers": headers
+        }
+        if is_aws_load_balancer:
+            response['statusDescription'] = '304 Not Modified'
+            response['isBase64Encoded'] = False
+        return response
 
-def build_response(result, expires, is_aws_load_balancer=False):
     response = {
         "statusCode": 200,
-        "body": json.dumps(result),
-        "headers": {
-            "Expires": format_date_time(expires),
-            "Access-Control-Allow-Origin": "*",
-            "Access-Control-Allow-Credentials": "true"
-        }
+        "body": body,
+        "headers": headers
     }
     if is_aws_load_balancer:
         response['statusDescription'] = '200 OK'
@@ -205,6 +545,10 @@ def build_response(result, expires, is_aws_load_balancer=False):
 
 
 def get_price_data(type_id, bpc):
+    cached = refined_cache.get((type_id, bpc))
+    if cached is not None:
+        return cached[0]
+
     kce = "type_id = :type_id AND is_bpc = :bpc"
     eav = {":type_id": type_id, ":bpc": str(bpc)}
     response = refined_table.query(
@@ -213,27 +557,35 @@ def get_price_data(type_id, bpc):
     )
 
     if response['Count'] == 0:
+        refined_cache.put((type_id, bpc), None, time.time() + refined_cache_time)
         return None
     else:
-        return map_price_data_from_dynamo(response['Items'][0])
-
-
-class PriceElement:
-    def __init__(self, price_per_unit, amount, timestamp, security, public_structure, contract_id, time_efficiency=0,
-                 material_efficiency=0):
-        self.contract_id = contract_id
-        self.amount = amount
-        self.security = security
-        self.material_efficiency = material_efficiency
-        self.time_efficiency = time_efficiency
-        self.public_structure = public_structure
-        self.timestamp = timestamp
-        self.price_per_unit = price_per_unit
-
-
-class TypeData:
-    def __init__(self, type_id, type_name, prices, is_bpc):
-        self.prices = prices
-        self.type_name = type_name
-        self.is_bpc = is_bpc
-        self.type_id = type_id
+        return map_price_data(response['Items'][0], bpc)
+
+
+def get_price_data_bulk(type_ids, bpc):
+    # refined items can be large, so they are mapped one at a time instead of holding all of them as dynamo items
+    keys = []
+    for type_id in type_ids:
+        cached = refined_cache.get((type_id, bpc))
+        if cached is None:
+            keys.append({'type_id': type_id, 'is_bpc': str(bpc)})
+        elif cached[0] is not None:
+            yield cached[0]
+    for chunk in range(0, len(keys), 25):
+        for entry in batch_get(dynamodb, refined_table.name, keys[chunk:chunk + 25]):
+            yield map_price_data(entry, bpc)
+
+
+def map_price_data(entry, bpc):
+    # refined items are migrated from a list of price maps to the compressed binary encoding
+    if price_encoding.is_encoded(entry):
+        price_data = price_encoding.read_current_type_data(entry, refined_table, refined_chunks_table)
+    else:
+        price_data = map_price_data_from_dynamo(entry)
+    if refined_cache.max_bytes > 0:
+        # cached price data is shared between requests, so it is sorted once before it is put and never modified
+        # afterwards, uncached price data is only sorted by since if a time window needs it
+        price_data.sort_by_timestamp()
+        refined_cache.put((price_data.type_id, bpc), price_data, time.time() + refined_cache_time)
+    return price_data
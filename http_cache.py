@@ -0,0 +1,111 @@
+import json
+import time
+import zlib
+from concurrent.futures import Future
+from email.utils import parsedate_to_datetime
+from dynamo_batch import batch_get
+
+default_table_name = 'contract-appraisal-http-cache'
+# bodies above this size (compressed) are not stored, only their ETag and expiry
+max_body_size = 350 * 1024
+# rows are kept for a while after they expired, as they can still be revalidated with their ETag
+row_retention = 30 * 24 * 60 * 60
+stored_headers = ['ETag', 'Expires', 'X-Pages']
+
+
+def parse_expires(headers):
+    if 'Expires' not in headers:
+        return 0
+    try:
+        return int(parsedate_to_datetime(headers['Expires']).timestamp())
+    except (TypeError, ValueError):
+        return 0
+
+
+def to_bytes(value):
+    # binary attributes are returned wrapped in boto3.dynamodb.types.Binary
+    return bytes(value.value) if hasattr(value, 'value') else bytes(value)
+
+
+class CachedResponse:
+    # stands in for a requests response when the body comes from the cache, status_code is 304 in that case
+    def __init__(self, entry):
+        self.status_code = 304
+        self.headers = dict(entry['headers'])
+        self.content = zlib.decompress(to_bytes(entry['body'])) if 'body' in entry else b''
+
+    def json(self):
+        return json.loads(self.content.decode('utf-8'))
+
+
+class ResponseCache:
+    # Caches ESI responses per url in memory and in contract-appraisal-http-cache. Urls whose Expires has not
+    # passed yet are answered from the cache without a request, the others are revalidated with If-None-Match
+    # and a 304 is answered with the cached body. Changes are written in batches with flush.
+    def __init__(self, dynamodb, table_name=default_table_name):
+        self.dynamodb = dynamodb
+        self.table_name = table_name
+        self.entries = {}
+        self.loaded = set()
+        self.dirty = set()
+
+    def prefetch(self, urls):
+        urls = [u for u in set(urls) if u not in self.loaded]
+        self.loaded.update(urls)
+        for item in batch_get(self.dynamodb, self.table_name, [{'url': u} for u in urls]):
+            self.entries[item['url']] = item
+
+    def get(self, client, url, need_body=True, etag=None):
+        # etag is used for urls that are not in the cache, like the one stored with a contract
+        if url not in self.loaded:
+            self.prefetch([url])
+        entry = self.entries.get(url)
+        if entry is not None and need_body and 'body' not in entry:
+            entry = None
+
+        if entry is not None and int(entry['expires']) > time.time():
+            future = Future()
+            future.set_result(CachedResponse(entry))
+            return future
+
+        headers = {}
+        if entry is not None:
+            headers['If-None-Match'] = entry['headers']['ETag']
+        elif etag is not None:
+            headers['If-None-Match'] = etag
+
+        future = Future()
+
+        def done(request_future):
+            try:
+                future.set_result(self.update(url, entry, request_future.result()))
+            except Exception as e:
+                future.set_exception(e)
+
+        client.get(url, headers=headers).add_done_callback(done)
+        return future
+
+    def update(self, url, entry, response):
+        if response.status_code == 304 and entry is not None:
+            entry['expires'] = parse_expires(response.headers)
+            entry['ttl'] = entry['expires'] + row_retention
+            self.dirty.add(url)
+            return CachedResponse(entry)
+        if response.status_code == 200 and 'ETag' in response.headers:
+            entry = {
+                'url': url,
+                'headers': dict((h, response.headers[h]) for h in stored_headers if h in response.headers),
+                'expires': parse_expires(response.headers)
+            }
+            entry['ttl'] = entry['expires'] + row_retention
+            body = zlib.compress(response.content)
+            if len(body) <= max_body_size:
+                entry['body'] = body
+            self.entries[url] = entry
+            self.dirty.add(url)
+        return response
+
+    def flush(self, writer):
+        for url in self.dirty:
+            writer.put(self.table_name, self.entries[url])
+        self.dirty = set()
@@ -0,0 +1,8 @@
+# used when a handler is invoked without a lambda context, e.g. when it is run locally
+default_time_budget = 200
+
+
+def remaining_seconds(context):
+    if context is None:
+        return default_time_budget
+    return context.get_remaining_time_in_millis() / 1000.0
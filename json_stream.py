@@ -0,0 +1,44 @@
+import codecs
+import json
+
+decoder = json.JSONDecoder()
+whitespace = ' \t\n\r'
+
+
+def iter_array(chunks):
+    # Yields the elements of a top level json array from an iterable of byte chunks, without ever holding the
+    # whole document or all of its elements in memory. Elements are expected to be objects or arrays, as a
+    # number at the end of a chunk could not be told apart from a truncated one.
+    text = codecs.getincrementaldecoder('utf-8')()
+    buffer = ''
+    started = False
+    finished = False
+    for chunk in chunks:
+        buffer += text.decode(chunk)
+        position = 0
+        while True:
+            while position < len(buffer) and (buffer[position] in whitespace or (started and buffer[position] == ',')):
+                position += 1
+            if position >= len(buffer):
+                break
+            if not started:
+                if buffer[position] != '[':
+                    raise ValueError('Expected a json array')
+                started = True
+                position += 1
+                continue
+            if buffer[position] == ']':
+                finished = True
+                break
+            try:
+                element, end = decoder.raw_decode(buffer, position)
+            except ValueError:
+                # the element continues in the next chunk
+                break
+            yield element
+            position = end
+        buffer = buffer[position:]
+        if finished:
+            return
+    if not finished:
+        raise ValueError('Unexpected end of json array')
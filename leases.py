@@ -0,0 +1,38 @@
+import time
+from uuid import uuid4
+
+
+def acquire(table, lease_id, duration):
+    # Takes a short lived lease on lease_id with a conditional put. Returns an owner token when the lease was
+    # acquired, or None if somebody else holds a lease that has not expired yet. Expired leases are taken over,
+    # so a crashed owner blocks others for at most duration seconds.
+    now = int(time.time())
+    owner = str(uuid4())
+    try:
+        table.put_item(
+            Item={
+                'lease_id': lease_id,
+                'owner': owner,
+                'expires': now + duration,
+                # leases are normally released, this only cleans up after crashed owners
+                'ttl': now + duration + 60 * 60
+            },
+            ConditionExpression='attribute_not_exists(lease_id) OR expires < :now',
+            ExpressionAttributeValues={':now': now}
+        )
+        return owner
+    except table.meta.client.exceptions.ConditionalCheckFailedException:
+        return None
+
+
+def release(table, lease_id, owner):
+    try:
+        table.delete_item(
+            Key={'lease_id': lease_id},
+            ConditionExpression='#owner = :owner',
+            ExpressionAttributeNames={'#owner': 'owner'},
+            ExpressionAttributeValues={':owner': owner}
+        )
+    except table.meta.client.exceptions.ConditionalCheckFailedException:
+        # the lease expired and was taken over by somebody else in the meantime, which is fine
+        pass
@@ -0,0 +1,93 @@
+import esi
+from dynamo_batch import batch_get
+
+# Security and public_structure of contract start locations, as used by the refined price data. Locations are
+# resolved once through esi and kept in contract-appraisal-locations as well as in memory across warm
+# invocations, they practically never change.
+default_table_name = 'contract-appraisal-locations'
+# npc stations, everything above is a player owned structure
+station_ids = range(60000000, 64000000)
+# j-space systems
+wormhole_system_ids = range(31000000, 32000000)
+# the system of a structure can't be looked up without authentication, so their security is not known
+unknown_security = 'unknown'
+
+known = {}
+systems = {}
+public_structures = None
+
+
+def security_name(system_id, security_status):
+    if system_id in wormhole_system_ids:
+        return 'wormhole'
+    if security_status >= 0.45:
+        return 'highsec'
+    if security_status > 0.0:
+        return 'lowsec'
+    return 'nullsec'
+
+
+def get_public_structures():
+    global public_structures
+    if public_structures is None:
+        response = esi.client.get('https://esi.evetech.net/v1/universe/structures/').result()
+        public_structures = set(response.json()) if response.status_code == 200 else set()
+    return public_structures
+
+
+def resolve(dynamodb, location_ids, writer, table_name=default_table_name):
+    # returns {location_id: {'security': ..., 'public_structure': ...}}, new locations are written with writer
+    location_ids = set(int(i) for i in location_ids)
+    missing = [i for i in location_ids if i not in known]
+    if len(missing) > 0:
+        for item in batch_get(dynamodb, table_name, [{'location_id': i} for i in missing]):
+            known[int(item['location_id'])] = {
+                'security': item['security'],
+                'public_structure': bool(item['public_structure'])
+            }
+        missing = [i for i in missing if i not in known]
+
+    if len(missing) > 0:
+        print('Resolving %d new locations' % len(missing))
+        for location_id, location in lookup(missing).items():
+            known[location_id] = location
+            item = dict(location)
+            item['location_id'] = location_id
+            writer.put(table_name, item)
+
+    return dict((i, known[i]) for i in location_ids if i in known)
+
+
+def lookup(location_ids):
+    result = {}
+    stations = {}
+    for location_id in location_ids:
+        if location_id in station_ids:
+            stations[location_id] = esi.client.get('https://esi.evetech.net/v2/universe/stations/%d/' % location_id)
+        else:
+            result[location_id] = {
+                'security': unknown_security,
+                'public_structure': location_id in get_public_structures()
+            }
+
+    station_systems = {}
+    for location_id, future in stations.items():
+        response = future.result()
+        if response.status_code != 200:
+            print('Received %d for station %d' % (response.status_code, location_id))
+            continue
+        station_systems[location_id] = int(response.json()['system_id'])
+
+    pending = dict((s, esi.client.get('https://esi.evetech.net/v4/universe/systems/%d/' % s))
+                   for s in set(station_systems.values()) if s not in systems)
+    for system_id, future in pending.items():
+        response = future.result()
+        if response.status_code != 200:
+            print('Received %d for system %d' % (response.status_code, system_id))
+            continue
+        systems[system_id] = security_name(system_id, float(response.json()['security_status']))
+
+    for location_id, system_id in station_systems.items():
+        if system_id in systems:
+            result[location_id] = {'security': systems[system_id], 'public_structure': True}
+    return result
@@ -1,23 +1,40 @@
 import json
-from requests_futures.sessions import FuturesSession
-import boto3
+from concurrent.futures import wait, FIRST_COMPLETED
 from collections import Counter
 from decimal import Decimal
-from uuid import uuid4
 import time
 from random import randint
 from datetime import datetime
-
-session = FuturesSession()
-dynamodb = boto3.resource('dynamodb', region_name='us-east-1')
-structures_table = dynamodb.Table('contract-appraisal-structures')
-contracts_table = dynamodb.Table('contract-appraisal-contracts')
-latest_id_table = dynamodb.Table('contract-appraisal-latest-contract-id')
-scheduling_table = dynamodb.Table('contract-appraisal-scheduling')
+from dynamo_batch import BatchWriter
+import esi
+import scheduler
+import clients
+from invocation import remaining_seconds
+import json_stream
+from http_cache import ResponseCache, parse_expires
+
+dynamodb = clients.dynamodb
+structures_table = clients.table('contract-appraisal-structures')
+contracts_table = clients.table('contract-appraisal-contracts')
+latest_id_table = clients.table('contract-appraisal-latest-contract-id')
+recheck_table = clients.table('contract-appraisal-recheck-schedule')
+backlog_table = clients.table('contract-appraisal-backlog')
+
+# fields of an item exchange contract that are kept from the region pages
+contract_fields = ['contract_id', 'type', 'title', 'price', 'volume', 'date_issued', 'date_expired',
+                   'start_location_id', 'end_location_id', 'issuer_id', 'issuer_corporation_id', 'for_corporation']
+page_chunk_size = 64 * 1024
+
+# seconds kept free at the end of a run for the writes of the last chunk
+time_reserve = 30
+# the time per contract is not known yet for the first chunk, so it is kept small
+initial_chunk_size = 250
+# the first recheck of a new contract is due within this many seconds after it was queued
+first_check_delay = (10 * 60, 60 * 60)
 
 
 def get_public_structures():
-    return session.get('https://esi.evetech.net/v1/universe/structures/').result().json()
+    return esi.client.get('https://esi.evetech.net/v1/universe/structures/').result().json()
 
 
 def get_latest_id():
@@ -44,174 +61,315 @@ def handle(event, context):
     print('Loading Contracts ...')
     contracts = parse_contracts(skip_pages)
     print('Loaded %d contracts from esi' % len(contracts))
-    if len(contracts) == 0:
-        return
 
-    print('Loading latest contract id ...')
+    if len(contracts) > 0:
+        print('Loading latest contract id ...')
 
-    latest_id = get_latest_id()
+        latest_id = get_latest_id()
 
-    print('Checking which contracts already exist for %d contracts ...' % len(contracts))
+        print('Checking which contracts already exist for %d contracts ...' % len(contracts))
 
-    new_latest_id = latest_id
-    new_contracts = []
-    for contract in contracts:
-        contract_id = int(contract['contract_id'])
-        if contract_id > latest_id:
-            if contract_id > new_latest_id:
-                new_latest_id = contract_id
-            new_contracts.append(contract)
-
-    set_latest_id(new_latest_id)
-
-    if len(new_contracts) > batch_size:
-        new_contracts = new_contracts[:batch_size]
-
-    print('Enhancing %d contracts ...' % len(new_contracts))
-    new_contracts = enhance_contracts(new_contracts)
-
-    for contract in new_contracts:
-        contracts_table.put_item(
-            Item=json.loads(json.dumps(contract), parse_float=Decimal)
-        )
-        scheduling_table.put_item(
-            Item={
-                'id': str(uuid4()),
-                'contract_id': contract['contract_id'],
-                # schedule the first check for within 10 to 60 minutes into the future
-                'ttl': int(time.time()) + randint(10 * 60, 60 * 60)
-            }
-        )
-
-    print('Added %d new contracts' % len(new_contracts))
+        new_latest_id = latest_id
+        # keyed by id, as a contract can show up on two pages while they shift and a batch write rejects duplicates
+        new_contracts = {}
+        for contract in contracts:
+            contract_id = int(contract['contract_id'])
+            if contract_id > latest_id:
+                if contract_id > new_latest_id:
+                    new_latest_id = contract_id
+                new_contracts[contract_id] = contract
+
+        # new contracts are queued in the backlog before the latest id moves past them, so contracts which
+        # don't fit into this run are picked up by the next one instead of being skipped
+        print('Queueing %d new contracts ...' % len(new_contracts))
+        writer = BatchWriter(dynamodb)
+        queued = int(time.time())
+        for contract in new_contracts.values():
+            item = dict(contract, first_check=queued + randint(*first_check_delay))
+            writer.put(backlog_table.name, json.loads(json.dumps(item), parse_float=Decimal))
+        writer.close()
+
+        set_latest_id(new_latest_id)
+
+    contracts = new_contracts = None
+    added = drain_backlog(context, batch_size)
+
+    print('Added %d new contracts' % added)
+    print('ESI stats: %s' % esi.client.stats())
 
     return 'ok'
 
 
+def drain_backlog(context, batch_size):
+    # Works through the backlog in chunks for as long as the lambda has time left. A chunk is only removed from
+    # the backlog after its contracts were written, so a timeout at worst repeats the chunk in progress.
+    added = 0
+    chunk_size = min(initial_chunk_size, batch_size)
+    while remaining_seconds(context) > time_reserve:
+        chunk = read_backlog(chunk_size)
+        if len(chunk) == 0:
+            break
+
+        started = time.time()
+        print('Enhancing %d contracts ...' % len(chunk))
+        contract_ids = [c['contract_id'] for c in chunk]
+        # enhanced contracts are handed to the writer one by one as they complete
+        cache = ResponseCache(dynamodb)
+        enhanced = enhance_contracts(chunk, cache)
+        chunk = None
+        writer = BatchWriter(dynamodb)
+        for contract in enhanced:
+            added += 1
+            due = first_check_due(contract, int(time.time()))
+            writer.put(contracts_table.name, json.loads(json.dumps(contract), parse_float=Decimal))
+            writer.put(recheck_table.name, scheduler.schedule_item(contract, due))
+        cache.flush(writer)
+        writer.flush()
+
+        for contract_id in contract_ids:
+            writer.delete(backlog_table.name, {'contract_id': contract_id})
+        writer.close()
+
+        # size the next chunk so that it fits into the remaining time
+        seconds_per_contract = (time.time() - started) / len(contract_ids)
+        fitting = int((remaining_seconds(context) - time_reserve) / max(seconds_per_contract, 0.001))
+        chunk_size = max(1, min(batch_size, fitting))
+
+    return added
+
+
+def first_check_due(contract, now):
+    # The due time is picked when the contract is queued and kept in its backlog row, so a chunk that is repeated
+    # after a timeout overwrites the same recheck row. If it already passed, it is moved on by whole hours, as the
+    # scheduler doesn't go back to buckets it processed. Older backlog rows without one get a random due time.
+    due = int(contract.pop('first_check', now + randint(*first_check_delay)))
+    if due <= now:
+        due += ((now - due) // 3600 + 1) * 3600
+    return due
+
+
+def read_backlog(limit):
+    contracts = []
+    kwargs = {'Limit': limit}
+    while len(contracts) < limit:
+        response = backlog_table.scan(**kwargs)
+        contracts.extend(from_dynamo(i) for i in response['Items'])
+        if 'LastEvaluatedKey' not in response:
+            break
+        kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+        kwargs['Limit'] = limit - len(contracts)
+    return contracts
+
+
+def from_dynamo(item):
+    # numbers come back from dynamodb as Decimal, which json can't serialize
+    return json.loads(json.dumps(item, default=lambda d: int(d) if d == d.to_integral_value() else float(d)))
+
+
 def get_etag_header(url, etags):
-    for e in etags:
-        if e['url'] == url:
-            return {'If-None-Match': e['value']}
+    if url in etags and 'value' in etags[url]:
+        return {'If-None-Match': etags[url]['value']}
     return {'If-None-Match': ''}
 
 
+def load_etags(etags_table):
+    # indexed by url, the table has one row per region page
+    etags = {}
+    kwargs = {}
+    while True:
+        response = etags_table.scan(**kwargs)
+        for e in response['Items']:
+            etags[e['url']] = e
+        if 'LastEvaluatedKey' not in response:
+            break
+        kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+    return etags
+
+
+def is_fresh(url, etags, now):
+    # esi would answer with the same cached page until it expires, so there is no point in asking before that
+    return url in etags and int(etags[url].get('expires', 0)) > now
+
+
 def parse_contracts(skip_pages):
 
-    etags_table = dynamodb.Table('contract-appraisal-etags')
-    etags = etags_table.scan()['Items']
+    etags_table = clients.table('contract-appraisal-etags')
+    etags = load_etags(etags_table)
+    changed = set()
+    now = time.time()
 
     contracts = []
-    new_etags = []
-    urls = []
+    futures = {}
+    region_started = {}
+    region_finished = {}
+    region_pages = Counter()
+    skipped = 0
+
+    def fetch(region_id, url):
+        future = esi.client.get(url, headers=get_etag_header(url, etags), parse=parse_contracts_page)
+        futures[future] = (region_id, url, time.time())
+
+    def fetch_pages(region_id, url, pages):
+        nonlocal skipped
+        if pages > 1 and not skip_pages:
+            for i in range(2, pages + 1):
+                page_url = url + ("?page=%d" % i)
+                if is_fresh(page_url, etags, now):
+                    skipped += 1
+                else:
+                    fetch(region_id, page_url)
 
     for region_id in range(10000001, 10000070):
         if region_id not in [10000024, 10000026]:  # skip non existent regions
-            urls.append('https://esi.evetech.net/v1/contracts/public/%d/' % region_id)
-
-    while len(urls) > 0:
-        futures = {}
-        for url in urls:
-            futures[url] = session.get(url, headers = get_etag_header(url, etags))
-
-        urls = []
-
-        for url, future in futures.items():
-            print('Loading contracts for %s' % url)
+            region_started[region_id] = time.time()
+            url = 'https://esi.evetech.net/v1/contracts/public/%d/' % region_id
+            if is_fresh(url, etags, now):
+                skipped += 1
+                # the first page is still cached by esi, but the others may have expired already
+                fetch_pages(region_id, url, int(etags[url].get('pages', 1)))
+            else:
+                fetch(region_id, url)
+
+    # a region's follow up pages are requested as soon as its first page arrived, instead of waiting for
+    # the first page of every other region
+    while len(futures) > 0:
+        done, _ = wait(list(futures.keys()), return_when=FIRST_COMPLETED)
+        for future in done:
+            region_id, url, started = futures.pop(future)
             response = future.result()
-            print('Response is %d' % response.status_code)
+            print('Response for %s is %d after %.2fs' % (url, response.status_code, time.time() - started))
+            region_pages[region_id] += 1
+            region_finished[region_id] = time.time()
             headers = response.headers
+            pages = None
             if 'X-Pages' in headers:
                 pages = int(headers['X-Pages'])
-                if pages > 1 and not skip_pages and '?page=' not in url:
-                    for i in range(2, pages + 1):
-                        urls.append(url + ("?page=%d" % i))
+                if '?page=' not in url:
+                    fetch_pages(region_id, url, pages)
 
-            if response.status_code is 200:
-                content = response.json()
-                for contract in content:
-                    if contract['type'] == 'item_exchange':
-                        contract['start_location_id'] = int(contract['start_location_id'])
-                        if contract['title'] == '':
-                            contract['title'] = 'n/a'
-                        contracts.append(contract)
+            if response.status_code == 200:
+                contracts.extend(response.parsed)
+
+            if response.status_code == 200 or response.status_code == 304:
+                update_etag(etags, changed, url, headers, pages)
 
-                new_etags.append({
-                    'url': url,
-                    'value': headers['ETag']
-                })
+    print('Skipped %d pages which did not expire yet' % skipped)
+    latencies = sorted(((region_finished[r] - region_started[r], r) for r in region_finished), reverse=True)
+    for latency, region_id in latencies[:5]:
+        print('Region %d took %.2fs for %d pages' % (region_id, latency, region_pages[region_id]))
 
-    for e in new_etags:
-        etags_table.put_item(Item=e)
+    writer = BatchWriter(dynamodb)
+    for url in changed:
+        writer.put(etags_table.name, etags[url])
+    writer.close()
 
     return contracts
 
 
-def most_common(lst):
-    data = Counter(lst)
-    return data.most_common(1)[0][0]
+def parse_contracts_page(response):
+    # Decodes a region page while it is downloaded and keeps only compact item exchange contracts. This runs on
+    # the esi client's worker threads, so pages are still downloaded and decoded in parallel.
+    if response.status_code != 200:
+        return None
+    contracts = []
+    for contract in json_stream.iter_array(response.iter_content(page_chunk_size)):
+        if contract['type'] == 'item_exchange':
+            contracts.append(compact_contract(contract))
+    return contracts
 
 
-def enhance_contracts(contracts):
+def compact_contract(contract):
+    # buyout is only used by auctions and reward, collateral and days_to_complete only by couriers
+    compact = dict((field, contract[field]) for field in contract_fields if field in contract)
+    compact['start_location_id'] = int(compact['start_location_id'])
+    if compact['title'] == '':
+        compact['title'] = 'n/a'
+    return compact
 
-    targets = []
 
-    for contract in contracts:
-        contract['contract_items'] = []
+def update_etag(etags, changed, url, headers, pages):
+    entry = dict(etags.get(url, {'url': url}))
+    if 'ETag' in headers:
+        entry['value'] = headers['ETag']
+    entry['expires'] = parse_expires(headers)
+    if pages is not None:
+        entry['pages'] = pages
+    if entry != etags.get(url):
+        etags[url] = entry
+        changed.add(url)
 
-        targets.append({
-            'url': 'https://esi.evetech.net/v1/contracts/public/items/%s/' % contract['contract_id'],
-            'contract_id': contract['contract_id']
-        })
 
-    while len(targets) > 0:
+def items_url(contract_id):
+    return 'https://esi.evetech.net/v1/contracts/public/items/%d/' % int(contract_id)
 
-        requests = []
-        for target in targets:
-            requests.append({
-                'url': target['url'],
-                'future': session.get(target['url']),
-                'contract_id': target['contract_id']
-            })
-        targets = []
 
-        for request in requests:
-            response = request['future'].result()
+def enhance_contracts(contracts, cache):
+    # Yields every contract as soon as all of its item pages are loaded, so the caller can write it right away
+    # and the items of finished contracts are not kept around until the whole batch is done. Pages come from
+    # the shared response cache where possible, so enhancing a contract again mostly costs 304s.
 
-            if response.status_code == 200:
+    index = {}
+    type_counts = {}
+    pending_pages = {}
+    futures = {}
+
+    def fetch(contract_id, url):
+        futures[cache.get(esi.client, url)] = (contract_id, url)
+
+    cache.prefetch([items_url(c['contract_id']) for c in contracts])
+    for contract in contracts:
+        contract_id = contract['contract_id']
+        contract['contract_items'] = []
+        index[contract_id] = contract
+        type_counts[contract_id] = Counter()
+        pending_pages[contract_id] = 1
+        fetch(contract_id, items_url(contract_id))
+    # only the index references the contracts from here on
+    contracts = None
+
+    while len(futures) > 0:
+        done, _ = wait(list(futures.keys()), return_when=FIRST_COMPLETED)
+        for future in done:
+            contract_id, url = futures.pop(future)
+            response = future.result()
+            contract = index[contract_id]
+
+            if response.status_code == 200 or response.status_code == 304:
                 content = response.json()
-                print('Response for %s has %d items' % (request['url'], len(content)))
-                for contract in contracts:
-                    if contract['contract_id'] == request['contract_id']:
-                        contract['contract_items'].extend(content)
-                        type_ids = []
-                        for i in contract['contract_items']:
-                            type_ids.append(int(i['type_id']))
-                        if len(type_ids) > 0:
-                            contract['most_common_type_id'] = most_common(type_ids)
-
-                headers = response.headers
-                pages = int(headers['X-Pages'])
-                if pages > 1 and '?page=' not in request['url']:
+                print('Response for %s has %d items' % (url, len(content)))
+                contract['contract_items'].extend(content)
+                for i in content:
+                    type_counts[contract_id][int(i['type_id'])] += 1
+
+                pages = int(response.headers['X-Pages'])
+                if pages > 1 and '?page=' not in url:
                     for i in range(2, pages + 1):
-                        targets.append({
-                            'url': request['url'] + ("?page=%d" % i),
-                            'contract_id': request['contract_id']
-                        })
+                        pending_pages[contract_id] += 1
+                        fetch(contract_id, url + ("?page=%d" % i))
             else:
-                print('Received %d for %s' % (response.status_code, request['url']))
+                print('Received %d for %s' % (response.status_code, url))
 
-    return contracts
+            pending_pages[contract_id] -= 1
+            if pending_pages[contract_id] == 0:
+                if len(type_counts[contract_id]) > 0:
+                    contract['most_common_type_id'] = type_counts[contract_id].most_common(1)[0][0]
+                del index[contract_id]
+                del type_counts[contract_id]
+                del pending_pages[contract_id]
+                yield contract
 
 
 def prep_for_db(contract):
-    contract['reward'] = float(contract['reward'])
+    if 'reward' in contract:
+        contract['reward'] = float(contract['reward'])
     contract['volume'] = float(contract['volume'])
-    contract['collateral'] = float(contract['collateral'])
-    contract['price'] = float(contract['price'])
+    if 'collateral' in contract:
+        contract['collateral'] = float(contract['collateral'])
     contract['price'] = float(contract['price'])
     contract['contract_id'] = int(contract['contract_id'])
     contract['start_location_id'] = int(contract['start_location_id'])
-    contract['days_to_complete'] = int(contract['days_to_complete'])
+    if 'days_to_complete' in contract:
+        contract['days_to_complete'] = int(contract['days_to_complete'])
     contract['issuer_corporation_id'] = int(contract['issuer_corporation_id'])
     contract['end_location_id'] = int(contract['end_location_id'])
     if 'most_common_type_id' in contract:
@@ -0,0 +1,78 @@
+import time
+from dynamo_batch import BatchWriter, batch_get
+import filter_stats
+import clients
+from price_filters import filters_from_key, get_cache_id, get_price_keys_id
+from getItemPrice import get_price_data, calculate_price, store_v2_price
+
+dynamodb = clients.dynamodb
+prices_v2 = clients.table('contract-appraisal-prices-v2')
+filter_stats_table = clients.table('contract-appraisal-filter-stats')
+
+# number of most requested filter combinations that are kept precomputed for every type
+hot_filter_count = 25
+
+
+def handle(event, context):
+    # runs on the stream of contract-appraisal-refined, so every change of a type's price data
+    # recomputes the hot filter combinations of that type into prices_v2
+    types = set()
+    for record in event['Records']:
+        if record['eventName'] == 'REMOVE':
+            continue
+        # note that the keys are in DynamoDB style, not regular python objects
+        keys = record['dynamodb']['Keys']
+        types.add((int(keys['type_id']['N']), keys['is_bpc']['S'] == 'True'))
+
+    if len(types) == 0:
+        return
+
+    # results for the last max_age days depend on when they are computed, so they are left to getItemPrice
+    hot_filters = [f for f in map(filters_from_key, filter_stats.hot_filter_keys(filter_stats_table, hot_filter_count))
+                   if f['max_age'] is None]
+    print('Precomputing %d filter combinations for %d types' % (len(hot_filters), len(types)))
+
+    tracked = read_price_keys(dynamodb, types)
+    writer = BatchWriter(dynamodb)
+    for type_id, bpc in types:
+        precompute_type(type_id, bpc, [f for f in hot_filters if f['bpc'] == bpc], tracked.get((type_id, bpc), set()),
+                        writer)
+    writer.close()
+
+    return 'ok'
+
+
+def read_price_keys(dynamodb, types):
+    # returns the price_keys written for each of the (type_id, bpc) types, see precompute_type
+    keys = [{'price_key': get_price_keys_id(type_id, bpc)} for type_id, bpc in types]
+    return dict(((int(item['type_id']), item['is_bpc'] == 'True'), set(item['price_keys']))
+                for item in batch_get(dynamodb, prices_v2.name, keys))
+
+
+def precompute_type(type_id, bpc, filters_list, previous_keys, writer):
+    # The price_keys written for a type are listed in a row of their own, so the refiner can mark all of them
+    # stale. Rows of filter combinations that are no longer hot are deleted here, nothing would update them.
+    price_data = get_price_data(type_id, bpc)
+    updated = int(time.time())
+    written = set()
+    for filters in filters_list:
+        cache_id = get_cache_id(type_id, filters)
+        # the column masks of price_data are shared between all combinations, so every column is only
+        # translated once per distinct filter value
+        result = None
+        if price_data is not None:
+            result = calculate_price(price_data, filters)
+        # prices_v2 has no notion of empty results, those are cached by getItemPrice itself
+        store_v2_price(cache_id, result, updated, writer)
+        if result is not None:
+            written.add(cache_id)
+
+    for cache_id in previous_keys - set(get_cache_id(type_id, f) for f in filters_list):
+        writer.delete(prices_v2.name, {'price_key': cache_id})
+    keys_id = get_price_keys_id(type_id, bpc)
+    if len(written) > 0:
+        writer.put(prices_v2.name, {'price_key': keys_id, 'type_id': type_id, 'is_bpc': str(bpc),
+                                    'price_keys': written})
+    elif len(previous_keys) > 0:
+        # dynamodb has no empty sets
+        writer.delete(prices_v2.name, {'price_key': keys_id})
@@ -0,0 +1,96 @@
+import json
+import time
+import threading
+from collections import OrderedDict
+from price_data import columns
+
+# rough per entry cost of the OrderedDict slot, the tuple and the dict holding the result on top of its json size
+entry_overhead = 600
+
+
+class PriceCache:
+    # In-memory LRU cache for price results which lives as long as the (warm) container. The size of an
+    # entry is estimated from its json encoding, which is what ends up in the response body anyway.
+    # Access is locked, as the server mode handles requests on several threads.
+    def __init__(self, max_bytes):
+        self.lock = threading.Lock()
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        with self.lock:
+            return self._get(key)
+
+    def _get(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        value, expires, size, keep_until = entry
+        if keep_until <= time.time():
+            self._remove(key)
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        # None is cached for results without any prices
+        if value is None:
+            return None, expires
+        return self.copy(value), expires
+
+    def put(self, key, value, expires, keep_until=None):
+        # expires is handed out with the value, keep_until drops the entry earlier than that, for values that can
+        # change in their origin before they expire
+        size = entry_overhead + len(str(key)) + self.measure(value)
+        if keep_until is None or keep_until > expires:
+            keep_until = expires
+        with self.lock:
+            self._put(key, value, expires, size, keep_until)
+
+    def _put(self, key, value, expires, size, keep_until):
+        if key in self.entries:
+            self._remove(key)
+        if size > self.max_bytes:
+            return
+        self.entries[key] = (self.copy(value) if value is not None else None, expires, size, keep_until)
+        self.size += size
+        while self.size > self.max_bytes:
+            oldest = next(iter(self.entries))
+            self._remove(oldest)
+            self.evictions += 1
+
+    def measure(self, value):
+        return len(json.dumps(value))
+
+    def copy(self, value):
+        # results are handed out as copies, as callers modify them
+        return dict(value)
+
+    def _remove(self, key):
+        self.size -= self.entries.pop(key)[2]
+
+    def stats(self):
+        with self.lock:
+            return {
+                'entries': len(self.entries),
+                'bytes': self.size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions
+            }
+
+
+class TypeDataCache(PriceCache):
+    # Keeps loaded refined price data by (type_id, bpc). Entries are shared instead of copied, so they have to be
+    # sorted by timestamp before they are put, nothing else modifies price data after loading.
+    def measure(self, value):
+        if value is None:
+            return 0
+        return sum(getattr(value, c).itemsize for c in columns) * len(value)
+
+    def copy(self, value):
+        return value
@@ -0,0 +1,131 @@
+from array import array
+from bisect import bisect_left
+from itertools import compress
+
+columns = ['price_per_unit', 'amount', 'timestamp', 'contract_id', 'security', 'public_structure',
+           'time_efficiency', 'material_efficiency']
+
+
+def byte_table(match):
+    # translation table mapping every byte value to 1 if it matches, otherwise 0
+    return bytes(1 if match(v) else 0 for v in range(256))
+
+
+def combine_masks(a, b):
+    if a is None:
+        return b
+    if b is None:
+        return a
+    return (int.from_bytes(a, 'little') & int.from_bytes(b, 'little')).to_bytes(len(a), 'little')
+
+
+class TypeData:
+    # Prices of a type are kept as parallel columns instead of one object per price. Securities are stored as
+    # indexes into security_names and efficiencies as signed bytes, so that filters on them are a single
+    # bytes.translate over the column and everything else works on compact arrays.
+    def __init__(self, type_id, type_name, is_bpc, security_names=None):
+        self.type_id = type_id
+        self.type_name = type_name
+        self.is_bpc = is_bpc
+        self.security_names = security_names if security_names is not None else []
+        self.price_per_unit = array('d')
+        self.amount = array('q')
+        self.timestamp = array('q')
+        self.contract_id = array('q')
+        self.security = array('B')
+        self.public_structure = array('b')
+        self.time_efficiency = array('b')
+        self.material_efficiency = array('b')
+        # column masks are kept, computing many filter combinations for the same type reuses them
+        self.column_masks = {}
+        # whether the prices are ordered by timestamp, which time windows rely on to be found by bisection
+        self.time_sorted = True
+
+    def __len__(self):
+        return len(self.price_per_unit)
+
+    def security_code(self, security):
+        if security not in self.security_names:
+            self.security_names.append(security)
+        return self.security_names.index(security)
+
+    def append(self, price_per_unit, amount, timestamp, security, public_structure, contract_id, time_efficiency=0,
+               material_efficiency=0):
+        if len(self.column_masks) > 0:
+            self.column_masks = {}
+        if len(self.timestamp) > 0 and timestamp < self.timestamp[-1]:
+            self.time_sorted = False
+        self.price_per_unit.append(price_per_unit)
+        self.amount.append(amount)
+        self.timestamp.append(timestamp)
+        self.security.append(self.security_code(security))
+        self.public_structure.append(1 if public_structure else 0)
+        self.contract_id.append(contract_id)
+        self.time_efficiency.append(time_efficiency)
+        self.material_efficiency.append(material_efficiency)
+
+    def column_mask(self, column, values):
+        key = (column, values)
+        if key not in self.column_masks:
+            self.column_masks[key] = getattr(self, column).tobytes().translate(byte_table(lambda v: v in values))
+        return self.column_masks[key]
+
+    def mask(self, securities=None, material_efficiency=None, time_efficiency=None):
+        # returns a bytes object with 1 for every matching price, or None if nothing is filtered
+        result = None
+        if securities is not None:
+            codes = tuple(i for i, name in enumerate(self.security_names) if name in securities)
+            result = self.column_mask('security', codes)
+        if material_efficiency is not None:
+            result = combine_masks(result, self.efficiency_mask('material_efficiency', material_efficiency))
+        if time_efficiency is not None:
+            result = combine_masks(result, self.efficiency_mask('time_efficiency', time_efficiency))
+        return result
+
+    def efficiency_mask(self, column, value):
+        # the efficiency columns hold signed bytes, a value outside of them matches nothing instead of aliasing
+        if not -128 <= value <= 127:
+            return bytes(len(self))
+        return self.column_mask(column, (value & 0xff,))
+
+    def select(self, column, mask):
+        values = getattr(self, column)
+        if mask is None:
+            return values
+        return array(values.typecode, compress(values, mask))
+
+    def subset(self, mask):
+        # a copy with only the prices where mask is 1, security codes stay valid as the names are copied as well
+        result = TypeData(self.type_id, self.type_name, self.is_bpc, list(self.security_names))
+        for column in columns:
+            setattr(result, column, self.select(column, mask))
+        result.time_sorted = self.time_sorted
+        return result
+
+    def sort_by_timestamp(self):
+        if self.time_sorted:
+            return
+        order = sorted(range(len(self)), key=self.timestamp.__getitem__)
+        for column in columns:
+            values = getattr(self, column)
+            setattr(self, column, array(values.typecode, (values[i] for i in order)))
+        self.column_masks = {}
+        self.time_sorted = True
+
+    def since(self, timestamp):
+        # a copy with only the prices at or after timestamp, the start of the window is found by bisection
+        self.sort_by_timestamp()
+        start = bisect_left(self.timestamp, timestamp)
+        result = TypeData(self.type_id, self.type_name, self.is_bpc, list(self.security_names))
+        for column in columns:
+            setattr(result, column, getattr(self, column)[start:])
+        return result
+
+
+def map_price_data_from_dynamo(entry):
+    result = TypeData(int(entry['type_id']), entry['type_name'], entry['is_bpc'])
+    for i in entry['prices']:
+        result.append(float(i['price_per_unit']), int(i['amount']), int(i['timestamp']),
+                      i['security'], i['public_structure'], int(i['contract_id']),
+                      int(i['time_efficiency']), int(i['material_efficiency']))
+    return result
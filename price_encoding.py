@@ -0,0 +1,183 @@
+import sys
+import zlib
+import random
+from array import array
+from price_data import TypeData, columns
+
+# Refined prices are stored as zlib compressed columns of fixed width values instead of a list of maps.
+# The compressed data is split into chunks: the first one is stored in the refined item itself, the rest
+# in contract-appraisal-refined-chunks. Chunks belong to a generation, so a rewrite of a type never
+# mixes the chunks of two versions for a reader. The columns are stored in the order of price_data.columns.
+encoding = 'zcol1'
+
+# leaves room for the other attributes within the 400 KB item limit
+inline_chunk_size = 300 * 1024
+chunk_size = 380 * 1024
+
+# Items with prices carry the timestamp of their oldest price and a shard, which are the key of the sparse
+# global secondary index oldest-index of contract-appraisal-refined (keys only). Items without prices have
+# neither, so the compaction finds expired prices by querying the index instead of scanning the table.
+oldest_index = 'oldest-index'
+oldest_shards = 10
+# a reader that lost the race against a rewrite of the type reads the new item, at most this often
+max_read_attempts = 3
+
+
+class ChunksReplaced(RuntimeError):
+    # the chunks of an item were deleted after it was read, because the type was written again in the meantime
+    pass
+
+
+def to_bytes(value):
+    # binary attributes are returned wrapped in boto3.dynamodb.types.Binary
+    return bytes(value.value) if hasattr(value, 'value') else bytes(value)
+
+
+def encode(type_data):
+    parts = []
+    for column in columns:
+        values = getattr(type_data, column)
+        if sys.byteorder == 'big' and values.itemsize > 1:
+            values = array(values.typecode, values)
+            values.byteswap()
+        parts.append(values.tobytes())
+    data = zlib.compress(b''.join(parts), 6)
+    chunks = [data[:inline_chunk_size]]
+    for i in range(inline_chunk_size, len(data), chunk_size):
+        chunks.append(data[i:i + chunk_size])
+    return chunks
+
+
+def decode(type_id, type_name, is_bpc, security_names, count, chunks):
+    result = TypeData(type_id, type_name, is_bpc, list(security_names))
+    data = zlib.decompress(b''.join(chunks))
+    offset = 0
+    for column in columns:
+        values = getattr(result, column)
+        size = values.itemsize * count
+        values.frombytes(data[offset:offset + size])
+        if sys.byteorder == 'big' and values.itemsize > 1:
+            values.byteswap()
+        offset += size
+    return result
+
+
+def chunk_key(type_id, is_bpc, generation):
+    return '%d-%s-%d' % (type_id, is_bpc, generation)
+
+
+def is_encoded(entry):
+    return entry.get('encoding') == encoding
+
+
+def read_type_data(entry, chunks_table):
+    chunks = [to_bytes(entry['prices_blob'])]
+    if int(entry['chunks']) > 1:
+        key = chunk_key(int(entry['type_id']), entry['is_bpc'], int(entry['generation']))
+        kwargs = {
+            'KeyConditionExpression': "price_key = :key",
+            'ExpressionAttributeValues': {":key": key}
+        }
+        items = []
+        while True:
+            response = chunks_table.query(**kwargs)
+            items.extend(response['Items'])
+            if 'LastEvaluatedKey' not in response:
+                break
+            kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+        items.sort(key=lambda i: int(i['chunk']))
+        if len(items) != int(entry['chunks']) - 1:
+            raise ChunksReplaced('Expected %d chunks for %s but found %d' % (int(entry['chunks']) - 1, key, len(items)))
+        chunks.extend(to_bytes(i['data']) for i in items)
+    result = decode(int(entry['type_id']), entry['type_name'], entry['is_bpc'], entry['security_names'],
+                    int(entry['price_count']), chunks)
+    # items written before prices were sorted are sorted on first use of a time window
+    result.time_sorted = entry.get('order') == 'timestamp'
+    return result
+
+
+def read_current_type_data(entry, refined_table, chunks_table):
+    # Like read_type_data, but if the chunks of entry were deleted by a rewrite in the meantime, the item that
+    # replaced it is read instead.
+    for attempt in range(max_read_attempts - 1):
+        try:
+            return read_type_data(entry, chunks_table)
+        except ChunksReplaced as e:
+            print('%s, reading the item again' % e)
+            key = {'type_id': int(entry['type_id']), 'is_bpc': entry['is_bpc']}
+            entry = refined_table.get_item(Key=key, ConsistentRead=True)['Item']
+    return read_type_data(entry, chunks_table)
+
+
+def write_condition(previous):
+    # the item is only replaced if it is still the one that was read, or created if there was none
+    if previous is None:
+        return {'ConditionExpression': 'attribute_not_exists(type_id)'}
+    if 'version' not in previous:
+        return {'ConditionExpression': 'attribute_not_exists(version)'}
+    return {
+        'ConditionExpression': 'version = :version',
+        'ExpressionAttributeValues': {':version': previous['version']}
+    }
+
+
+def write_type_data(refined_table, chunks_table, type_data, previous=None, **attributes):
+    # previous is the refined item that is being replaced, if any. Its chunks are removed after the switch.
+    # Raises the client's ConditionalCheckFailedException if the item was changed since previous was read,
+    # callers then read it again and retry.
+    type_id = int(type_data.type_id)
+    is_bpc = str(type_data.is_bpc)
+    # random rather than counted up, so two writers racing on the same type never write the same chunk rows
+    generation = random.getrandbits(48)
+    version = 1
+    if previous is not None:
+        version = int(previous.get('version', 0)) + 1
+
+    # prices are stored ordered by timestamp, so readers can find a time window by bisection
+    type_data.sort_by_timestamp()
+    chunks = encode(type_data)
+    key = chunk_key(type_id, is_bpc, generation)
+    with chunks_table.batch_writer() as batch:
+        for i, data in enumerate(chunks[1:]):
+            batch.put_item(Item={'price_key': key, 'chunk': i + 1, 'data': data})
+
+    item = dict(attributes)
+    item.update({
+        'type_id': type_id,
+        'is_bpc': is_bpc,
+        'type_name': type_data.type_name,
+        'encoding': encoding,
+        'generation': generation,
+        'version': version,
+        'chunks': len(chunks),
+        'price_count': len(type_data),
+        'order': 'timestamp',
+        'security_names': list(type_data.security_names),
+        'prices_blob': chunks[0]
+    })
+    if len(type_data) > 0:
+        item['oldest'] = type_data.timestamp[0]
+        item['oldest_shard'] = type_id % oldest_shards
+    else:
+        # copied from previous, but an item without prices must leave the index
+        item.pop('oldest', None)
+        item.pop('oldest_shard', None)
+    try:
+        refined_table.put_item(Item=item, **write_condition(previous))
+    except Exception:
+        # the new chunks are not referenced by anything
+        delete_chunks(chunks_table, key, len(chunks))
+        raise
+
+    if previous is not None and is_encoded(previous) and int(previous['chunks']) > 1:
+        delete_chunks(chunks_table, chunk_key(type_id, is_bpc, int(previous['generation'])), int(previous['chunks']))
+    return item
+
+
+def delete_chunks(chunks_table, key, count):
+    # the first chunk is stored in the refined item itself
+    if count <= 1:
+        return
+    with chunks_table.batch_writer() as batch:
+        for i in range(1, count):
+            batch.delete_item(Key={'price_key': key, 'chunk': i})
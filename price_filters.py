@@ -0,0 +1,108 @@
+import calendar
+from datetime import datetime
+
+security_flags = {
+    'highsec': 1,
+    'lowsec': 2,
+    'nullsec': 4,
+    'wormhole': 8
+}
+all_securities = 15
+
+
+def security_mask(security):
+    # "lowsec,highsec" and "highsec,lowsec" are the same filter, so securities are stored as a bitmask
+    mask = 0
+    for name in security.split(','):
+        name = name.strip()
+        if name == '':
+            continue
+        if name not in security_flags:
+            raise ValueError("Unknown security %s, valid values are %s." % (name, ','.join(security_flags)))
+        mask |= security_flags[name]
+    if mask == 0:
+        raise ValueError("At least one security is required.")
+    return mask
+
+
+def security_names(mask):
+    return [name for name, flag in security_flags.items() if mask & flag]
+
+
+def default_filters():
+    return {
+        'material_efficiency': None,
+        'time_efficiency': None,
+        'include_private': False,
+        'securities': all_securities,
+        'bpc': False,
+        'weighted': False,
+        # only prices of the last max_age days, or issued at or after the unix timestamp since
+        'max_age': None,
+        'since': None
+    }
+
+
+def parse_since(value):
+    # unix timestamp or an esi style date like 2019-06-01 or 2019-06-01T12:00:00Z
+    try:
+        since = int(value)
+        if since >= 0:
+            return since
+    except ValueError:
+        pass
+    for date_format in ('%Y-%m-%d', '%Y-%m-%dT%H:%M:%SZ'):
+        try:
+            return calendar.timegm(datetime.strptime(value, date_format).timetuple())
+        except ValueError:
+            pass
+    raise ValueError("The parameter since must be a unix timestamp or a date like 2019-06-01.")
+
+
+def window_start(filters, now):
+    # the earliest timestamp of prices included by filters, or None if there is no time window
+    if filters['since'] is not None:
+        return filters['since']
+    if filters['max_age'] is not None:
+        return int(now) - filters['max_age'] * 24 * 60 * 60
+    return None
+
+
+def filter_key(filters):
+    # canonical representation of a filter combination, the cache id of a price is "<type_id>-<filter key>"
+    key = "%s-%s-%s-s%d-%s" % (filters['material_efficiency'], filters['time_efficiency'],
+                               filters['include_private'], filters['securities'], filters['bpc'])
+    if filters['weighted']:
+        key += "-weighted"
+    if filters['max_age'] is not None:
+        key += "-age%d" % filters['max_age']
+    if filters['since'] is not None:
+        key += "-since%d" % filters['since']
+    return key
+
+
+def filters_from_key(key):
+    parts = key.split('-')
+    filters = default_filters()
+    filters['material_efficiency'] = None if parts[0] == 'None' else int(parts[0])
+    filters['time_efficiency'] = None if parts[1] == 'None' else int(parts[1])
+    filters['include_private'] = parts[2] == 'True'
+    filters['securities'] = int(parts[3][1:])
+    filters['bpc'] = parts[4] == 'True'
+    for part in parts[5:]:
+        if part == 'weighted':
+            filters['weighted'] = True
+        elif part.startswith('age'):
+            filters['max_age'] = int(part[3:])
+        elif part.startswith('since'):
+            filters['since'] = int(part[5:])
+    return filters
+
+
+def get_cache_id(type_id, filters):
+    return "%d-%s" % (type_id, filter_key(filters))
+
+
+def get_price_keys_id(type_id, bpc):
+    # the prices_v2 row that lists the price_keys precompute wrote for a type, it can't collide with a cache id
+    return "keys-%d-%s" % (type_id, bpc)
@@ -0,0 +1,102 @@
+import math
+from bisect import bisect_right
+
+# fraction of the cheapest prices averaged into five_percent
+low_fraction = 0.05
+# below this many prices there is no meaningful low 5%, so five_percent falls back to the minimum
+low_minimum_count = 20
+
+
+def percentile_key(p):
+    return 'p%d' % p
+
+
+def percentile(sorted_values, p):
+    # linear interpolation between the closest ranks, p=50 is identical to statistics.median
+    position = (len(sorted_values) - 1) * p / 100.0
+    lower = int(math.floor(position))
+    upper = min(lower + 1, len(sorted_values) - 1)
+    fraction = position - lower
+    return sorted_values[lower] + (sorted_values[upper] - sorted_values[lower]) * fraction
+
+
+def low_mean(sorted_values):
+    n = len(sorted_values)
+    if n < low_minimum_count:
+        return sorted_values[0]
+    count = int(n * low_fraction)
+    return math.fsum(sorted_values[:count]) / count
+
+
+def summarize(values, percentiles=()):
+    # All order statistics are read off a single sort, which CPython does in C and which beats a pure python
+    # selection for every list size we see. Additional percentiles are therefore just an index lookup each.
+    if len(values) == 0:
+        return None
+    ordered = sorted(values)
+    result = {
+        'median': percentile(ordered, 50),
+        'average': math.fsum(ordered) / len(ordered),
+        'minimum': ordered[0],
+        'maximum': ordered[-1],
+        'five_percent': low_mean(ordered)
+    }
+    for p in percentiles:
+        result[percentile_key(p)] = percentile(ordered, p)
+    return result
+
+
+def unit_price(values, order, cumulative, unit):
+    # the price of the unit at index unit, if every price was repeated once per unit in price order
+    return values[order[min(bisect_right(cumulative, unit), len(order) - 1)]]
+
+
+def weighted_percentile(values, order, cumulative, total, p):
+    # interpolated between the closest units like percentile, so with all weights 1 the results are identical
+    position = max(total - 1, 0) * p / 100.0
+    lower = math.floor(position)
+    fraction = position - lower
+    lower_price = unit_price(values, order, cumulative, lower)
+    return lower_price + (unit_price(values, order, cumulative, lower + 1) - lower_price) * fraction
+
+
+def weighted_summarize(values, weights, percentiles=()):
+    # Same statistics as summarize, but every price counts as often as its weight (the amount of units).
+    # Only the price order is materialized, as a list of indexes, so memory stays linear in the number of
+    # prices no matter how many units a contract had.
+    if len(values) == 0:
+        return None
+    total = math.fsum(weights)
+    if total <= 0:
+        return None
+
+    order = sorted(range(len(values)), key=values.__getitem__)
+    cumulative = []
+    running = 0.0
+    for index in order:
+        running += weights[index]
+        cumulative.append(running)
+
+    if total < low_minimum_count:
+        five = values[order[0]]
+    else:
+        remaining = total * low_fraction
+        low_sum = 0.0
+        for index in order:
+            units = min(weights[index], remaining)
+            low_sum += values[index] * units
+            remaining -= units
+            if remaining <= 0:
+                break
+        five = low_sum / (total * low_fraction)
+
+    result = {
+        'median': weighted_percentile(values, order, cumulative, total, 50),
+        'average': math.fsum(v * w for v, w in zip(values, weights)) / total,
+        'minimum': values[order[0]],
+        'maximum': values[order[-1]],
+        'five_percent': five
+    }
+    for p in percentiles:
+        result[percentile_key(p)] = weighted_percentile(values, order, cumulative, total, p)
+    return result
@@ -0,0 +1,289 @@
+import time
+import calendar
+from datetime import datetime
+import esi
+import locations
+import filter_stats
+import clients
+from invocation import remaining_seconds
+import price_encoding
+from dynamo_batch import BatchWriter, backoff, batch_get
+from price_data import TypeData, map_price_data_from_dynamo
+from price_filters import filters_from_key, get_cache_id, get_price_keys_id
+
+dynamodb = clients.dynamodb
+refined_table = clients.table('contract-appraisal-refined')
+refined_chunks_table = clients.table('contract-appraisal-refined-chunks')
+prices_v2 = clients.table('contract-appraisal-prices-v2')
+filter_stats_table = clients.table('contract-appraisal-filter-stats')
+
+# a type that is changed by another invocation at the same time is read and written again
+max_write_attempts = 5
+# same as in precompute, rows of hot filter combinations are marked stale even if they aren't listed yet
+hot_filter_count = 25
+# prices older than this are dropped by the compaction, they are outside of any useful time window
+price_retention = 180 * 24 * 60 * 60
+# seconds kept free at the end of a compaction run for the last write
+time_reserve = 15
+
+
+def build_deserializer():
+    from boto3.dynamodb.types import TypeDeserializer
+    return TypeDeserializer()
+
+
+deserializer = clients.Lazy(build_deserializer)
+
+
+def handle(event, context):
+    # Runs on the stream of contract-appraisal-contracts (new images) and keeps contract-appraisal-refined up to
+    # date. New contracts add their price to the refined data of their type, contracts that were scored 0
+    # (expired or deleted without being accepted) or removed take it out again. Only the types that changed are
+    # read and written, and their precomputed prices in prices_v2 are marked stale until precompute replaces them.
+    started = int(time.time())
+    # the last change of a contract within the batch decides what happens to it
+    changes = {}
+    for record in event['Records']:
+        event_name = record['eventName']
+        if event_name == 'MODIFY' and not is_scored_zero(record):
+            continue
+        if event_name == 'REMOVE':
+            contract = from_image(record['dynamodb'].get('OldImage'))
+        else:
+            contract = from_image(record['dynamodb'].get('NewImage'))
+        if contract is None or 'contract_id' not in contract:
+            continue
+        add = event_name == 'INSERT' and int(contract.get('score', 1)) != 0
+        changes[int(contract['contract_id'])] = (contract, add)
+
+    added = {}
+    removed = {}
+    for contract, add in changes.values():
+        entry = price_entry(contract)
+        if entry is None:
+            continue
+        key = (entry['type_id'], entry['is_bpc'])
+        if add:
+            added.setdefault(key, []).append(entry)
+        else:
+            removed.setdefault(key, set()).add(entry['contract_id'])
+
+    types = set(added.keys()) | set(removed.keys())
+    if len(types) == 0:
+        return 'ok'
+    print('Refining %d added and %d removed contracts for %d types'
+          % (sum(len(a) for a in added.values()), sum(len(r) for r in removed.values()), len(types)))
+
+    writer = BatchWriter(dynamodb)
+    location_ids = set(e['location_id'] for entries in added.values() for e in entries)
+    known_locations = locations.resolve(dynamodb, location_ids, writer)
+
+    changed = []
+    for type_id, is_bpc in types:
+        entries = [e for e in added.get((type_id, is_bpc), []) if e['location_id'] in known_locations]
+        if apply_changes(type_id, is_bpc, entries, removed.get((type_id, is_bpc), set()), known_locations):
+            changed.append((type_id, is_bpc))
+
+    print('Updated the refined data of %d types' % len(changed))
+    if len(changed) > 0:
+        mark_stale(changed, started, writer)
+    writer.close()
+    return 'ok'
+
+
+def from_image(image):
+    # stream images are in DynamoDB style, not regular python objects
+    if image is None:
+        return None
+    return dict((k, deserializer.deserialize(v)) for k, v in image.items())
+
+
+def is_scored_zero(record):
+    old_image = record['dynamodb'].get('OldImage', {})
+    new_image = record['dynamodb'].get('NewImage', {})
+    if 'score' not in new_image:
+        return False
+    if int(new_image['score']['N']) != 0:
+        return False
+    return 'score' not in old_image or int(old_image['score']['N']) != 0
+
+
+def price_entry(contract):
+    # A contract only yields a price if everything it contains is of its most common type, the price can't be
+    # split between different types otherwise. Contracts that ask for items in return are skipped as well.
+    if 'most_common_type_id' not in contract or len(contract.get('contract_items', [])) == 0:
+        return None
+    type_id = int(contract['most_common_type_id'])
+    items = contract['contract_items']
+    if any(not i.get('is_included', True) or int(i['type_id']) != type_id for i in items):
+        return None
+
+    is_bpc = bool(items[0].get('is_blueprint_copy', False))
+    material_efficiency = int(items[0].get('material_efficiency', 0))
+    time_efficiency = int(items[0].get('time_efficiency', 0))
+    for i in items:
+        if bool(i.get('is_blueprint_copy', False)) != is_bpc \
+                or int(i.get('material_efficiency', 0)) != material_efficiency \
+                or int(i.get('time_efficiency', 0)) != time_efficiency:
+            return None
+
+    amount = sum(int(i['quantity']) for i in items)
+    price = float(contract['price'])
+    if amount <= 0 or price <= 0:
+        return None
+    return {
+        'type_id': type_id,
+        'is_bpc': is_bpc,
+        'contract_id': int(contract['contract_id']),
+        'location_id': int(contract['start_location_id']),
+        'price_per_unit': price / amount,
+        'amount': amount,
+        'timestamp': calendar.timegm(datetime.strptime(contract['date_issued'], '%Y-%m-%dT%H:%M:%SZ').timetuple()),
+        'material_efficiency': material_efficiency,
+        'time_efficiency': time_efficiency
+    }
+
+
+def apply_changes(type_id, is_bpc, entries, removed, known_locations):
+    # Drops the removed contracts and appends the new ones. Contracts that are added again (a stream record
+    # delivered twice) replace their earlier price instead of counting twice. Returns whether anything changed.
+    dropped = removed | set(e['contract_id'] for e in entries)
+
+    def change(current):
+        if current is None:
+            if len(entries) == 0:
+                return None
+            type_name = get_type_name(type_id)
+            if type_name is None:
+                return None
+            type_data = TypeData(type_id, type_name, is_bpc)
+        else:
+            keep = bytes(0 if c in dropped else 1 for c in current.contract_id)
+            if len(entries) == 0 and all(keep):
+                return None
+            type_data = current.subset(keep)
+
+        for e in entries:
+            location = known_locations[e['location_id']]
+            type_data.append(e['price_per_unit'], e['amount'], e['timestamp'], location['security'],
+                             location['public_structure'], e['contract_id'], e['time_efficiency'],
+                             e['material_efficiency'])
+        return type_data
+
+    return update_type(type_id, is_bpc, change)
+
+
+def update_type(type_id, is_bpc, change):
+    # Reads the refined item, applies change to its price data (None if there is no item yet) and writes the
+    # result back, but only if the item wasn't changed in the meantime, otherwise it starts over. change returns
+    # None if there is nothing to write. Returns whether anything was written.
+    for attempt in range(max_write_attempts):
+        response = refined_table.get_item(Key={'type_id': type_id, 'is_bpc': str(is_bpc)}, ConsistentRead=True)
+        previous = response.get('Item')
+        try:
+            type_data = change(read_type_data(previous) if previous is not None else None)
+        except price_encoding.ChunksReplaced:
+            print('Refined data of %d %s was replaced while reading it, retrying' % (type_id, is_bpc))
+            time.sleep(backoff(attempt))
+            continue
+        if type_data is None:
+            return False
+
+        attributes = {}
+        if previous is not None:
+            # keep any other attributes of the item, the prices of the list format are replaced by the encoding
+            attributes = dict((k, v) for k, v in previous.items() if k != 'prices')
+        try:
+            price_encoding.write_type_data(refined_table, refined_chunks_table, type_data, previous=previous,
+                                           **attributes)
+            return True
+        except refined_table.meta.client.exceptions.ConditionalCheckFailedException:
+            print('Refined data of %d %s changed concurrently, retrying' % (type_id, is_bpc))
+            time.sleep(backoff(attempt))
+    raise RuntimeError('Could not update the refined data of %d %s after %d attempts'
+                       % (type_id, is_bpc, max_write_attempts))
+
+
+def handle_compaction(event, context):
+    # Runs periodically and drops prices older than price_retention from the refined data, so items don't grow
+    # forever. The items whose oldest price has expired are queried from the sparse oldest index, one shard at a
+    # time, so only their keys are read. What doesn't fit into one run is left to the next one.
+    started = int(time.time())
+    cutoff = started - price_retention
+
+    def change(current):
+        if current is None:
+            return None
+        compacted = current.since(cutoff)
+        if len(compacted) == len(current):
+            return None
+        return compacted
+
+    changed = []
+    finished = True
+    for shard in range(price_encoding.oldest_shards):
+        if remaining_seconds(context) < time_reserve:
+            finished = False
+            break
+        kwargs = {
+            'IndexName': price_encoding.oldest_index,
+            'KeyConditionExpression': 'oldest_shard = :shard AND oldest < :cutoff',
+            'ExpressionAttributeValues': {':shard': shard, ':cutoff': cutoff}
+        }
+        while finished:
+            response = refined_table.query(**kwargs)
+            for item in response['Items']:
+                if remaining_seconds(context) < time_reserve:
+                    finished = False
+                    break
+                type_id, is_bpc = int(item['type_id']), item['is_bpc'] == 'True'
+                if update_type(type_id, is_bpc, change):
+                    changed.append((type_id, is_bpc))
+            if 'LastEvaluatedKey' not in response:
+                break
+            kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+    print('Compacted the refined data of %d types%s' % (len(changed), '' if finished else ', more are left'))
+    if len(changed) > 0:
+        writer = BatchWriter(dynamodb)
+        mark_stale(changed, started, writer)
+        writer.close()
+    return 'ok'
+
+
+def read_type_data(entry):
+    if price_encoding.is_encoded(entry):
+        return price_encoding.read_type_data(entry, refined_chunks_table)
+    return map_price_data_from_dynamo(entry)
+
+
+def get_type_name(type_id):
+    response = esi.client.get('https://esi.evetech.net/v3/universe/types/%d/' % type_id).result()
+    if response.status_code != 200:
+        print('Received %d for type %d' % (response.status_code, type_id))
+        return None
+    return response.json()['name']
+
+
+def mark_stale(types, started, writer):
+    # Marks every row precompute listed for the types, and those of the hot filter combinations. Rows that don't
+    # exist are not created, and rows precompute already rewrote from the new refined data since started are left
+    # alone, the condition makes the update a no-op for both.
+    hot_filters = [f for f in map(filters_from_key, filter_stats.hot_filter_keys(filter_stats_table, hot_filter_count))
+                   if f['max_age'] is None]
+    listed = {}
+    keys = [{'price_key': get_price_keys_id(type_id, is_bpc)} for type_id, is_bpc in types]
+    for item in batch_get(dynamodb, prices_v2.name, keys):
+        listed[(int(item['type_id']), item['is_bpc'] == 'True')] = set(item['price_keys'])
+    for type_id, is_bpc in types:
+        price_keys = set(get_cache_id(type_id, f) for f in hot_filters if f['bpc'] == is_bpc)
+        for price_key in price_keys | listed.get((type_id, is_bpc), set()):
+            writer.update(
+                prices_v2.name,
+                Key={'price_key': price_key},
+                UpdateExpression="SET stale = :started",
+                ConditionExpression="attribute_exists(price_key) AND #updated <= :started",
+                ExpressionAttributeNames={'#updated': 'updated'},
+                ExpressionAttributeValues={':started': started},
+                ReturnValues="NONE"
+            )
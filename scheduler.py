@@ -0,0 +1,70 @@
+# Rechecks are stored in buckets of bucket_size seconds, with the start of the bucket as partition key and the
+# contract_id as sort key. A periodic job queries the buckets that are due, so rechecks don't depend on
+# DynamoDB TTL deletion, which can lag by hours. Rows are removed by TTL once they are long past, which
+# costs no write capacity.
+bucket_size = 5 * 60
+# the job's progress is kept in a row of its own, below any real bucket
+cursor_key = {'bucket': 0, 'contract_id': 0}
+# how far back the job starts when there is no cursor yet
+initial_lookback = 6 * 60 * 60
+row_retention = 24 * 60 * 60
+
+
+def bucket_for(timestamp):
+    return int(timestamp) // bucket_size * bucket_size
+
+
+def schedule_item(contract, due):
+    # date_issued and ETag are copied into the row, so the contract doesn't have to be looked up when it is due
+    item = {
+        'bucket': bucket_for(due),
+        'contract_id': contract['contract_id'],
+        'due': int(due),
+        'date_issued': contract['date_issued'],
+        'ttl': int(due) + row_retention
+    }
+    if 'ETag' in contract:
+        item['ETag'] = contract['ETag']
+    return item
+
+
+def to_contract(item):
+    contract = {
+        'contract_id': int(item['contract_id']),
+        'date_issued': item['date_issued']
+    }
+    if 'ETag' in item:
+        contract['ETag'] = item['ETag']
+    return contract
+
+
+def due_buckets(table, now):
+    # buckets are only due once they are over, so nothing can be added to them after they were processed
+    response = table.get_item(Key=cursor_key, ConsistentRead=True)
+    if 'Item' in response:
+        start = int(response['Item']['next_bucket'])
+    else:
+        start = bucket_for(now - initial_lookback)
+    return list(range(start, bucket_for(now), bucket_size))
+
+
+def read_bucket(table, bucket):
+    items = []
+    kwargs = {
+        'KeyConditionExpression': "#bucket = :bucket",
+        'ExpressionAttributeNames': {"#bucket": "bucket"},
+        'ExpressionAttributeValues': {":bucket": bucket}
+    }
+    while True:
+        response = table.query(**kwargs)
+        items.extend(response['Items'])
+        if 'LastEvaluatedKey' not in response:
+            break
+        kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+    return items
+
+
+def set_cursor(table, next_bucket):
+    item = dict(cursor_key)
+    item['next_bucket'] = next_bucket
+    table.put_item(Item=item)
@@ -0,0 +1,81 @@
+import os
+import sys
+import json
+import argparse
+import subprocess
+
+# Measures the init time of every lambda handler, which is the time it takes to import its module in a fresh
+# interpreter, like on a cold start. Fails if the median of a handler is over its budget, or if a handler
+# imports one of the heavy client libraries during init instead of on first use.
+# usage: python scripts/cold_start_benchmark.py [--runs 5] [--budget-ms 150]
+
+root = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+# milliseconds, the 128 MB price and feedback functions get the least cpu, so they have the tightest budgets
+budgets = {
+    'getItemPrice': 100,
+    'feedback': 100,
+    'parser': 150,
+    'expiry_updater': 150,
+    'precompute': 150,
+    'refiner': 150
+}
+# built lazily through clients and esi, importing any of them during init is a regression
+heavy_modules = ['boto3', 'botocore', 'requests', 'requests_futures']
+
+measure_code = """
+import sys, time, json
+started = time.perf_counter()
+import %s
+elapsed = time.perf_counter() - started
+print(json.dumps({'ms': elapsed * 1000, 'heavy': [m for m in %r if m in sys.modules]}))
+"""
+
+
+def measure(module):
+    # returns (milliseconds, heavy modules), a fresh interpreter is started for every run
+    output = subprocess.check_output([sys.executable, '-c', measure_code % (module, heavy_modules)], cwd=root,
+                                     stderr=subprocess.STDOUT)
+    result = json.loads(output.decode('utf-8').strip().splitlines()[-1])
+    return result['ms'], result['heavy']
+
+
+def median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2 == 1:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measures the cold start init time of the lambda handlers')
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--budget-ms', type=float, help='one budget for all handlers instead of the defaults')
+    args = parser.parse_args()
+
+    failed = False
+    for module, budget in sorted(budgets.items()):
+        if args.budget_ms is not None:
+            budget = args.budget_ms
+        try:
+            runs = [measure(module) for _ in range(args.runs)]
+        except subprocess.CalledProcessError as e:
+            print('%-16s failed to import:\n%s' % (module, e.output.decode('utf-8')))
+            failed = True
+            continue
+        ms = median([r[0] for r in runs])
+        heavy = sorted(set(m for r in runs for m in r[1]))
+        problems = []
+        if ms > budget:
+            problems.append('over budget')
+        if len(heavy) > 0:
+            problems.append('imports %s during init' % ', '.join(heavy))
+        print('%-16s %7.1f ms (budget %.0f ms) %s' % (module, ms, budget, ', '.join(problems) or 'ok'))
+        failed = failed or len(problems) > 0
+
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
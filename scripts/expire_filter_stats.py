@@ -0,0 +1,45 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import filter_stats  # noqa: E402
+import clients  # noqa: E402
+
+# Gives every row of contract-appraisal-filter-stats that was written before rows had a TTL one, counted from
+# when it was last requested. Rows of time windows with their parameter in the key are never updated anymore
+# and are removed by it. Rows that have a TTL are skipped, so the script can be stopped and run again.
+# usage: python scripts/expire_filter_stats.py [--dry-run]
+
+filter_stats_table = clients.table('contract-appraisal-filter-stats')
+
+
+def expire(dry_run):
+    updated = 0
+    skipped = 0
+    kwargs = {}
+    while True:
+        response = filter_stats_table.scan(**kwargs)
+        for item in response['Items']:
+            if 'ttl' in item:
+                skipped += 1
+                continue
+            ttl = int(item.get('last_seen', 0)) + filter_stats.row_retention
+            print('%s expires at %d' % (item['filter_key'], ttl))
+            if not dry_run:
+                filter_stats_table.update_item(
+                    Key={'filter_key': item['filter_key']},
+                    UpdateExpression="SET #ttl = if_not_exists(#ttl, :ttl)",
+                    ExpressionAttributeNames={'#ttl': 'ttl'},
+                    ExpressionAttributeValues={':ttl': ttl},
+                    ReturnValues="NONE"
+                )
+            updated += 1
+        if 'LastEvaluatedKey' not in response:
+            break
+        kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+    print('Set the TTL of %d rows, skipped %d' % (updated, skipped))
+
+
+if __name__ == '__main__':
+    expire('--dry-run' in sys.argv)
@@ -0,0 +1,79 @@
+import os
+import sys
+import json
+import random
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import json_stream  # noqa: E402
+from parser import compact_contract, page_chunk_size  # noqa: E402
+
+# Compares the peak memory of decoding a region contracts page at once with json.loads against decoding it
+# incrementally with json_stream, keeping the same compact item exchange contracts in both cases.
+# usage: python scripts/measure_page_memory.py <recorded page.json>
+#        python scripts/measure_page_memory.py --synthetic 1000
+
+contract_types = ['item_exchange', 'item_exchange', 'courier', 'auction']
+
+
+def synthetic_page(count):
+    contracts = []
+    for i in range(count):
+        contracts.append({
+            'buyout': 0, 'collateral': 0.0, 'contract_id': 150000000 + i,
+            'date_expired': '2026-10-30T12:00:00Z', 'date_issued': '2026-10-16T12:00:00Z',
+            'days_to_complete': 0, 'end_location_id': 60003760, 'for_corporation': False,
+            'issuer_corporation_id': 98000000 + i % 1000, 'issuer_id': 90000000 + i % 5000,
+            'price': float(random.randint(1, 10 ** 9)), 'reward': 0.0, 'start_location_id': 60003760,
+            'title': 'contract %d' % i if i % 3 else '', 'type': contract_types[i % len(contract_types)],
+            'volume': random.random() * 1000
+        })
+    return json.dumps(contracts).encode('utf-8')
+
+
+def chunks(body):
+    # the body arrives in pieces of page_chunk_size like with response.iter_content
+    for i in range(0, len(body), page_chunk_size):
+        yield body[i:i + page_chunk_size]
+
+
+def whole(body):
+    # the full body is held in memory here, like response.content followed by response.json()
+    content = b''.join(chunks(body))
+    return [compact_contract(c) for c in json.loads(content.decode('utf-8')) if c['type'] == 'item_exchange']
+
+
+def streamed(body):
+    return [compact_contract(c) for c in json_stream.iter_array(chunks(body)) if c['type'] == 'item_exchange']
+
+
+def measure(name, function, body):
+    # the page itself is the same in both cases and allocated before tracing starts, so it is not counted
+    tracemalloc.start()
+    baseline = tracemalloc.get_traced_memory()[0]
+    result = function(body)
+    peak = tracemalloc.get_traced_memory()[1] - baseline
+    tracemalloc.stop()
+    print('%-8s peak %8.1f KB for %d contracts' % (name, peak / 1024.0, len(result)))
+    return peak
+
+
+def main():
+    if len(sys.argv) == 3 and sys.argv[1] == '--synthetic':
+        body = synthetic_page(int(sys.argv[2]))
+    elif len(sys.argv) == 2:
+        with open(sys.argv[1], 'rb') as f:
+            body = f.read()
+    else:
+        print('usage: measure_page_memory.py <page.json> | --synthetic <count>')
+        sys.exit(1)
+
+    print('page size %.1f KB' % (len(body) / 1024.0))
+    before = measure('loads', whole, body)
+    after = measure('stream', streamed, body)
+    print('streaming uses %.0f%% of the peak memory' % (100.0 * after / before))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,56 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from price_data import map_price_data_from_dynamo  # noqa: E402
+import price_encoding  # noqa: E402
+import clients  # noqa: E402
+
+# Converts every refined item that still stores its prices as a list of maps to the compressed binary
+# encoding. Encoded items with prices that are not in the oldest index yet are rewritten as well, sorted and
+# with the index attributes, so the compaction finds them. Items that are done are skipped, so the script can
+# be stopped and run again.
+# usage: python scripts/migrate_refined.py [--dry-run]
+
+refined_table = clients.table('contract-appraisal-refined')
+refined_chunks_table = clients.table('contract-appraisal-refined-chunks')
+
+
+def needs_migration(entry):
+    if price_encoding.is_encoded(entry):
+        return 'oldest_shard' not in entry and int(entry['price_count']) > 0
+    return 'prices' in entry
+
+
+def migrate(dry_run):
+    converted = 0
+    skipped = 0
+    kwargs = {}
+    while True:
+        response = refined_table.scan(**kwargs)
+        for entry in response['Items']:
+            if not needs_migration(entry):
+                skipped += 1
+                continue
+            if price_encoding.is_encoded(entry):
+                type_data = price_encoding.read_type_data(entry, refined_chunks_table)
+            else:
+                type_data = map_price_data_from_dynamo(entry)
+            chunks = price_encoding.encode(type_data)
+            print('%d %s: %d prices in %d bytes and %d chunks'
+                  % (type_data.type_id, type_data.is_bpc, len(type_data), sum(len(c) for c in chunks), len(chunks)))
+            if not dry_run:
+                # keep any other attributes of the item, only the prices are replaced
+                attributes = dict((k, v) for k, v in entry.items() if k != 'prices')
+                price_encoding.write_type_data(refined_table, refined_chunks_table, type_data, previous=entry,
+                                               **attributes)
+            converted += 1
+        if 'LastEvaluatedKey' not in response:
+            break
+        kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+    print('Converted %d items, skipped %d' % (converted, skipped))
+
+
+if __name__ == '__main__':
+    migrate('--dry-run' in sys.argv)
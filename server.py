@@ -0,0 +1,174 @@
+import os
+import sys
+import json
+import asyncio
+import argparse
+from http import HTTPStatus
+from concurrent.futures import ThreadPoolExecutor
+
+# Serves the price api from one long running process, e.g. behind an application load balancer, instead of
+# a lambda per request. Requests are turned into load balancer events for the lambda handlers, which run on a
+# thread pool, so the in-memory caches of getItemPrice are shared by all requests and stay warm.
+# usage: python server.py [--host 0.0.0.0] [--port 8080] [--workers 32]
+# Set DYNAMODB_ENDPOINT=http://localhost:8000 (and any AWS credentials) to run against DynamoDB Local.
+
+default_workers = 32
+# the process has the memory for a much larger hot set than a 128 MB lambda, both can be overridden
+os.environ.setdefault('PRICE_CACHE_BYTES', str(256 * 1024 * 1024))
+os.environ.setdefault('REFINED_CACHE_BYTES', str(1024 * 1024 * 1024))
+
+max_header_lines = 100
+keep_alive_timeout = 60
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Serves the price api over http')
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=int(os.environ.get('PORT', 8080)))
+    parser.add_argument('--workers', type=int, default=int(os.environ.get('SERVER_WORKERS', default_workers)))
+    return parser.parse_args()
+
+
+def to_event(method, target, headers):
+    # same shape as the events of an application load balancer, which doesn't decode query parameters either
+    path, _, query = target.partition('?')
+    parameters = {}
+    for pair in query.split('&'):
+        if pair == '':
+            continue
+        name, _, value = pair.partition('=')
+        parameters[name] = value
+    return {
+        'requestContext': {'elb': {'targetGroupArn': 'local'}},
+        'httpMethod': method,
+        'path': path,
+        'queryStringParameters': parameters,
+        'headers': headers,
+        'body': '',
+        'isBase64Encoded': False
+    }
+
+
+def route(event):
+    # returns the handler for a request, or None if there is none
+    import getItemPrice
+    if event['httpMethod'] != 'GET':
+        return None
+    if event['path'] in ('/prices', '/prices/'):
+        return getItemPrice.handle_bulk
+    if getItemPrice.price_path.match(event['path']):
+        return getItemPrice.handle
+    return None
+
+
+def error_response(status, message):
+    return {'statusCode': status, 'body': json.dumps({'error': message}), 'headers': {}}
+
+
+def health_response():
+    import getItemPrice
+    body = {
+        'price_cache': getItemPrice.price_cache.stats(),
+        'refined_cache': getItemPrice.refined_cache.stats()
+    }
+    return {'statusCode': 200, 'body': json.dumps(body), 'headers': {'Content-Type': 'application/json'}}
+
+
+def to_bytes(response, keep_alive):
+    status = response['statusCode']
+    reason = HTTPStatus(status).phrase
+    body = response.get('body') or ''
+    if isinstance(body, str):
+        body = body.encode('utf-8')
+    headers = dict(response.get('headers') or {})
+    headers['Content-Length'] = str(len(body))
+    headers['Connection'] = 'keep-alive' if keep_alive else 'close'
+    if len(body) > 0 and 'Content-Type' not in headers:
+        headers['Content-Type'] = 'application/json'
+    lines = ['HTTP/1.1 %d %s' % (status, reason)] + ['%s: %s' % (k, v) for k, v in headers.items()]
+    return ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1') + body
+
+
+class Server:
+    def __init__(self, workers):
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+
+    async def handle_connection(self, reader, writer):
+        try:
+            while True:
+                request = await self.read_request(reader)
+                if request is None:
+                    break
+                method, target, headers = request
+                keep_alive = headers.get('connection', '').lower() != 'close'
+                response = await self.dispatch(method, target, headers)
+                writer.write(to_bytes(response, keep_alive))
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (asyncio.TimeoutError, ConnectionError, ValueError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def read_request(self, reader):
+        # returns (method, target, headers) or None once the client closed the connection
+        line = await asyncio.wait_for(reader.readline(), keep_alive_timeout)
+        if line == b'':
+            return None
+        parts = line.decode('latin-1').split()
+        if len(parts) != 3:
+            raise ValueError('Malformed request line')
+        headers = {}
+        for _ in range(max_header_lines):
+            line = await asyncio.wait_for(reader.readline(), keep_alive_timeout)
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+        else:
+            raise ValueError('Too many headers')
+        # the api has no request bodies, but one that was sent anyway must not be read as the next request
+        length = int(headers.get('content-length', 0))
+        if length > 0:
+            await reader.readexactly(length)
+        return parts[0], parts[1], headers
+
+    async def dispatch(self, method, target, headers):
+        event = to_event(method, target, headers)
+        if event['path'] == '/health':
+            return health_response()
+        handler = route(event)
+        if handler is None:
+            return error_response(404, 'Not found')
+        loop = asyncio.get_event_loop()
+        try:
+            return await loop.run_in_executor(self.executor, handler, event, None)
+        except Exception as e:
+            print('Failed to handle %s: %r' % (target, e))
+            return error_response(500, 'Internal error')
+
+
+def main():
+    args = parse_args()
+    os.environ.setdefault('DYNAMODB_POOL_SIZE', str(args.workers))
+    # the handlers only read the environment when they are imported
+    import getItemPrice  # noqa: F401
+
+    server = Server(args.workers)
+    loop = asyncio.get_event_loop()
+    listener = loop.run_until_complete(asyncio.start_server(server.handle_connection, args.host, args.port))
+    print('Serving the price api on %s:%d with %d workers' % (args.host, args.port, args.workers))
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        listener.close()
+        loop.run_until_complete(listener.wait_closed())
+        server.executor.shutdown()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,106 @@
+import os
+import sys
+import math
+import random
+import statistics
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import quantiles  # noqa: E402
+
+# small sizes around the edge cases, then large lists of both parities
+sizes = [1, 2, 3, 19, 20, 21, 39, 40, 41, 999, 1000, 10000, 10001]
+checked_percentiles = (0, 5, 10, 25, 50, 75, 90, 99, 100)
+
+
+def random_lists(rng, n):
+    # unique floats, and integers from a small range so there are many duplicates
+    yield [rng.uniform(0.01, 1e9) for _ in range(n)]
+    yield [rng.randint(1, 50) for _ in range(n)]
+    yield [7.5] * n
+
+
+def low_mean(values):
+    # mean of the cheapest 5%, or the minimum if there are fewer than 20 values
+    ordered = sorted(values)
+    if len(ordered) < 20:
+        return ordered[0]
+    count = len(ordered) // 20
+    return math.fsum(ordered[:count]) / count
+
+
+def unit_low_mean(values):
+    # the weighted version covers exactly 5% of the units, including a fraction of the last price
+    ordered = sorted(values)
+    if len(ordered) < 20:
+        return ordered[0]
+    units = len(ordered) * 0.05
+    whole = int(units)
+    total = math.fsum(ordered[:whole]) + (ordered[whole] * (units - whole) if whole < len(ordered) else 0)
+    return total / units
+
+
+class QuantilesTest(unittest.TestCase):
+    def assertClose(self, actual, expected, message):
+        self.assertTrue(math.isclose(actual, expected, rel_tol=1e-9, abs_tol=1e-9),
+                        '%s: %r != %r' % (message, actual, expected))
+
+    def assertMatches(self, result, values, five_percent):
+        ordered = sorted(values)
+        n = len(values)
+        self.assertClose(result['median'], statistics.median(values), 'median of %d' % n)
+        self.assertClose(result['average'], math.fsum(values) / n, 'average of %d' % n)
+        self.assertEqual(result['minimum'], ordered[0])
+        self.assertEqual(result['maximum'], ordered[-1])
+        self.assertClose(result['five_percent'], five_percent, 'five_percent of %d' % n)
+
+    def test_summarize(self):
+        rng = random.Random(20261018)
+        for n in sizes:
+            for values in random_lists(rng, n):
+                result = quantiles.summarize(values, (0, 50, 100))
+                self.assertMatches(result, values, low_mean(values))
+                self.assertClose(result['p50'], result['median'], 'p50 of %d' % n)
+                self.assertEqual(result['p0'], result['minimum'])
+                self.assertEqual(result['p100'], result['maximum'])
+
+    def test_summarize_does_not_modify_values(self):
+        values = [3, 1, 2]
+        quantiles.summarize(values)
+        self.assertEqual(values, [3, 1, 2])
+
+    def test_weighted_summarize_with_unit_weights(self):
+        rng = random.Random(1018)
+        for n in sizes:
+            for values in random_lists(rng, n):
+                result = quantiles.weighted_summarize(values, [1] * n, checked_percentiles)
+                self.assertMatches(result, values, unit_low_mean(values))
+                expected = quantiles.summarize(values, checked_percentiles)
+                for p in checked_percentiles:
+                    key = quantiles.percentile_key(p)
+                    self.assertClose(result[key], expected[key], '%s of %d' % (key, n))
+                if n % 20 == 0:
+                    # a whole number of units, the same prices as the unweighted mean
+                    self.assertClose(result['five_percent'], low_mean(values), 'five_percent of %d' % n)
+
+    def test_weighted_percentiles_repeat_prices(self):
+        # a price with weight k is the same as k prices of one unit
+        rng = random.Random(2026)
+        for n in [1, 2, 3, 20, 101]:
+            values = [rng.randint(1, 30) * 1.5 for _ in range(n)]
+            weights = [rng.randint(1, 5) for _ in range(n)]
+            repeated = [v for v, w in zip(values, weights) for _ in range(w)]
+            result = quantiles.weighted_summarize(values, weights, checked_percentiles)
+            expected = quantiles.summarize(repeated, checked_percentiles)
+            for key in ['median'] + [quantiles.percentile_key(p) for p in checked_percentiles]:
+                self.assertClose(result[key], expected[key], '%s of %d' % (key, n))
+
+    def test_empty(self):
+        self.assertIsNone(quantiles.summarize([]))
+        self.assertIsNone(quantiles.weighted_summarize([], []))
+        self.assertIsNone(quantiles.weighted_summarize([1.0], [0]))
+
+
+if __name__ == '__main__':
+    unittest.main()